@@ -0,0 +1,224 @@
+"""A versioned JSON API, under /api/v1.
+
+    GET /api/v1/movies                   movies, with their rating summaries
+    GET /api/v1/movies/<movie_id>
+    GET /api/v1/users
+    GET /api/v1/users/<user_id>
+    GET /api/v1/users/<user_id>/ratings
+
+?fields=movie_id,title,average_rating picks the fields returned (all of
+them by default), and only the columns those fields need are selected;
+rows come back as plain tuples, never as ORM objects. Lists are pages
+keyed on the primary key, like the HTML listings:
+
+    {"items": [...], "prev_cursor": null, "next_cursor": "MTAw"}
+
+with ?after=<next_cursor> (or ?before=<prev_cursor>) and ?limit= to page.
+
+Responses are encoded with orjson when it's installed (pip install
+orjson) and the json module otherwise, and compressed with Brotli (pip
+install brotli) or gzip, whichever the client accepts, when they're
+bigger than COMPRESS_MIN_BYTES. Errors are JSON too: {"error": "..."}.
+"""
+
+import json
+import zlib
+from collections import namedtuple
+
+from flask import Blueprint, Response, abort, request
+from werkzeug.exceptions import HTTPException
+
+import crud
+from model import Movie, Rating, SCORES, User
+
+try:
+    import orjson
+except ImportError:  # Faster encoding is optional.
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; gzip is always there.
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024  # smaller responses aren't worth the CPU
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # the top qualities are far too slow for per-request use
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+Field = namedtuple("Field", ["columns", "value"])
+"""An API field: the columns it's read from and value(row) -> JSON value."""
+
+
+def column_field(column):
+    return Field((column,), lambda row: row._mapping[column])
+
+
+def _average_rating(row):
+    rating_count = row._mapping[Movie.rating_count]
+    if not rating_count:
+        return None
+
+    return row._mapping[Movie.rating_sum] / rating_count
+
+
+_score_columns = tuple(Movie.score_column(score) for score in SCORES)
+
+MOVIE_FIELDS = {
+    "movie_id": column_field(Movie.movie_id),
+    "title": column_field(Movie.title),
+    "overview": column_field(Movie.overview),
+    "release_date": column_field(Movie.release_date),
+    "poster_path": column_field(Movie.poster_path),
+    "rating_count": column_field(Movie.rating_count),
+    "average_rating": Field((Movie.rating_sum, Movie.rating_count), _average_rating),
+    "histogram": Field(_score_columns,  # ratings per score, 0-5
+                       lambda row: [row._mapping[column] for column in _score_columns]),
+}
+
+USER_FIELDS = {
+    "user_id": column_field(User.user_id),
+    "email": column_field(User.email),
+}
+
+RATING_FIELDS = {
+    "rating_id": column_field(Rating.rating_id),
+    "movie_id": column_field(Rating.movie_id),
+    "score": column_field(Rating.score),
+    "movie_title": column_field(Movie.title),
+}
+
+
+def dumps(data):
+    """Encode data as JSON bytes (dates and datetimes in ISO 8601)."""
+
+    if orjson is not None:
+        return orjson.dumps(data)
+
+    return json.dumps(data, separators=(",", ":"), default=lambda value: value.isoformat()
+                      ).encode()
+
+
+def _compressed(body):
+    """Return (body, content_encoding) compressed as the client accepts."""
+
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted.quality("br") > 0:
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if accepted.quality("gzip") > 0:
+        compressor = zlib.compressobj(GZIP_LEVEL, wbits=16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush(), "gzip"
+
+    return body, None
+
+
+def json_response(data, status=200):
+    body, encoding = _compressed(dumps(data))
+    response = Response(body, status=status, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+
+    return response
+
+
+@api.errorhandler(HTTPException)
+def http_error(error):
+    return json_response({"error": error.description}, error.code)
+
+
+def selected_fields(fields, key_column=None):
+    """Return ({name: Field} asked for in ?fields=, columns to select).
+
+    key_column, which keyed pages need, is always selected.
+    """
+
+    names = [name.strip() for name in request.args.get("fields", "").split(",")
+             if name.strip()] or list(fields)
+    unknown = [name for name in names if name not in fields]
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(unknown)}. "
+                   f"Known fields: {', '.join(fields)}.")
+
+    selected = {name: fields[name] for name in names}
+    columns = [key_column] if key_column is not None else []
+    for field in selected.values():
+        columns.extend(column for column in field.columns if column not in columns)
+
+    return selected, columns
+
+
+def _item(row, selected):
+    return {name: field.value(row) for name, field in selected.items()}
+
+
+def _page_response(fields, key_column, *criteria, joins=None):
+    """joins maps other models to the relationship joining them in, for
+    when a selected field reads from them."""
+
+    selected, columns = selected_fields(fields, key_column)
+    joins = [join for model, join in (joins or {}).items()
+             if any(column.class_ is model for column in columns)]
+    try:
+        page = crud.get_columns_page(
+            columns, key_column, *criteria, joins=joins,
+            after=request.args.get("after"), before=request.args.get("before"),
+            limit=request.args.get("limit", crud.DEFAULT_PAGE_SIZE, type=int))
+    except ValueError as error:
+        abort(400, str(error))
+
+    return json_response({"items": [_item(row, selected) for row in page.items],
+                          "prev_cursor": page.prev_cursor,
+                          "next_cursor": page.next_cursor})
+
+
+def _row_response(fields, *criteria):
+    selected, columns = selected_fields(fields)
+    row = crud.get_columns_row(columns, *criteria)
+    if row is None:
+        abort(404, "Not found.")
+
+    return json_response(_item(row, selected))
+
+
+@api.route("/movies")
+def movies():
+    """A page of movies, with their rating summaries."""
+
+    return _page_response(MOVIE_FIELDS, Movie.movie_id)
+
+
+@api.route("/movies/<int:movie_id>")
+def movie(movie_id):
+    """One movie."""
+
+    return _row_response(MOVIE_FIELDS, Movie.movie_id == movie_id)
+
+
+@api.route("/users")
+def users():
+    """A page of users."""
+
+    return _page_response(USER_FIELDS, User.user_id)
+
+
+@api.route("/users/<int:user_id>")
+def user(user_id):
+    """One user."""
+
+    return _row_response(USER_FIELDS, User.user_id == user_id)
+
+
+@api.route("/users/<int:user_id>/ratings")
+def user_ratings(user_id):
+    """A page of one user's ratings."""
+
+    if crud.get_user_version(user_id) is None:
+        abort(404, "Not found.")
+
+    return _page_response(RATING_FIELDS, Rating.rating_id, Rating.user_id == user_id,
+                          joins={Movie: Rating.movie})
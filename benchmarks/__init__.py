@@ -0,0 +1 @@
+"""Benchmarks for the movie ratings app. Run each module with python3 -m."""
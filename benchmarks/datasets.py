@@ -0,0 +1,31 @@
+"""Fixed-size benchmark datasets, built with bulk_seed.py.
+
+Each scale always produces the same database (same sizes, same RNG seed),
+so results from different runs and branches are comparable.
+"""
+
+import bulk_seed
+
+SEED = 29
+
+# name: (users, movies, ratings per user)
+SCALES = {
+    "1k": (50, 100, 20),             # 1,000 ratings
+    "100k": (2000, 1000, 50),        # 100,000 ratings
+    "10m": (100000, 20000, 100),     # 10,000,000 ratings
+}
+
+
+def rating_count(scale):
+    users, _, ratings_per_user = SCALES[scale]
+    return users * ratings_per_user
+
+
+def build(scale, db_uri):
+    """(Re)create the database at db_uri with the dataset for scale."""
+
+    users, movies, ratings_per_user = SCALES[scale]
+
+    bulk_seed.main(["--users", str(users), "--movies", str(movies),
+                    "--ratings-per-user", str(ratings_per_user),
+                    "--seed", str(SEED), "--db-uri", db_uri])
@@ -0,0 +1,68 @@
+"""Benchmark login throughput under concurrency.
+
+    $ python3 -m benchmarks.login --threads 1 4 16 --seconds 5
+
+Creates a throwaway user, then hammers POST /login through the Flask test
+client from a growing number of threads and prints logins/s for each.
+Password checks run on the bounded pool in passwords.py, so throughput
+should level off around PASSWORD_HASH_WORKERS rather than collapse.
+"""
+
+import argparse
+import threading
+import time
+
+import crud
+import model
+import server
+
+EMAIL = "login-bench@test.com"
+PASSWORD = "bench"
+
+
+def run(app, thread_count, seconds):
+    """Return (logins, elapsed) for thread_count threads logging in."""
+
+    deadline = time.perf_counter() + seconds
+    counts = [0] * thread_count
+
+    def worker(index):
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            response = client.post("/login", data={"email": EMAIL, "password": PASSWORD})
+            assert response.status_code == 302, response.status_code
+            counts[index] += 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(index,))
+               for index in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(counts), time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark POST /login.")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--db-uri", default="postgresql:///ratings")
+    args = parser.parse_args(argv)
+
+    app = server.create_app({"DATABASE_URI": args.db_uri})
+
+    with app.app_context():
+        model.db.create_all()
+        if not crud.get_user_by_email(EMAIL):
+            crud.create_user(EMAIL, PASSWORD)
+
+    for thread_count in args.threads:
+        logins, elapsed = run(app, thread_count, args.seconds)
+        print(f"{thread_count:>3} threads: {logins / elapsed:8.1f} logins/s "
+              f"({logins} in {elapsed:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Load test the connection pool settings.
+
+    $ python3 -m benchmarks.pool --threads 32 --pool-sizes 2 5 10 20 --seconds 10
+
+For each pool size, a fresh app connects with DB_POOL_SIZE set to it (the
+other DB_* settings come from the environment as usual) and --threads
+threads run uncached crud reads flat out. Throughput, p99 latency and the
+pool's checkout-wait counters show when workers are queueing for
+connections rather than waiting on PostgreSQL.
+"""
+
+import argparse
+import random
+import threading
+import time
+
+from flask import Flask
+
+import crud
+import model
+from benchmarks import datasets
+from benchmarks.suite import percentile
+
+
+def load(pool_size, args):
+    app = Flask(f"pool-{pool_size}")
+    app.config["DB_POOL_SIZE"] = pool_size
+    app.config["DB_MAX_OVERFLOW"] = 0  # so the pool size is the real limit
+    model.connect_to_db(app, args.db_uri)
+
+    users, _, _ = datasets.SCALES[args.scale]
+    deadline = time.perf_counter() + args.seconds
+    latencies = [[] for _ in range(args.threads)]
+
+    def worker(index):
+        rng = random.Random(index)
+        with app.app_context():
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                crud.get_user_ratings_page(rng.randint(1, users))
+                model.db.session.remove()  # give the connection back
+                latencies[index].append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=worker, args=(index,))
+               for index in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    all_latencies = sorted(latency for thread in latencies for latency in thread)
+    with app.app_context():
+        pool = model.db.engine.pool
+        wait_ms = (pool.wait_seconds / max(pool.checkouts, 1) * 1000
+                   if isinstance(pool, model.InstrumentedQueuePool) else float("nan"))
+        model.db.engine.dispose()
+
+    print(f"pool {pool_size:>3}: {len(all_latencies) / args.seconds:8.1f} ops/s, "
+          f"p99 {percentile(all_latencies, 0.99) * 1000:7.2f}ms, "
+          f"avg checkout wait {wait_ms:6.2f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test pool settings.")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[2, 5, 10, 20])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--scale", choices=sorted(datasets.SCALES), default="100k",
+                        help="dataset the database was built with")
+    parser.add_argument("--db-uri", default="postgresql:///ratings_bench")
+    args = parser.parse_args(argv)
+
+    for pool_size in args.pool_sizes:
+        load(pool_size, args)
+
+
+if __name__ == "__main__":
+    main()
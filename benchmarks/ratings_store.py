@@ -0,0 +1,55 @@
+"""Benchmark the columnar ratings store.
+
+    $ python3 -m benchmarks.ratings_store --ratings 10000000 --users 500000 --movies 50000
+
+Builds a RatingsStore from synthetic ratings (see benchmarks.recommender),
+saves and memory-maps it, then times its stats queries.
+"""
+
+import argparse
+import tempfile
+import time
+
+from benchmarks.recommender import synthetic_ratings
+from ratings_store import RatingsStore
+
+
+def timed(label, function, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    print(f"{label}: {(time.perf_counter() - start) / repeat * 1000:.2f}ms")
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ratings store.")
+    parser.add_argument("--ratings", type=int, default=10000000)
+    parser.add_argument("--users", type=int, default=500000)
+    parser.add_argument("--movies", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=29)
+    args = parser.parse_args(argv)
+
+    triples = synthetic_ratings(args.ratings, args.users, args.movies, args.seed)
+    print(f"{len(triples[2])} distinct ratings")
+
+    store = timed("build", lambda: RatingsStore.from_arrays(*triples))
+    print(f"size: {store.nbytes / 2**20:.1f}MB "
+          f"({store.nbytes / max(store.rating_count, 1):.1f} bytes a rating)")
+
+    with tempfile.TemporaryDirectory() as directory:
+        timed("save", lambda: store.save(directory))
+        mapped = timed("load (mmap)", lambda: RatingsStore.load(directory))
+
+        timed("movie_stats", mapped.movie_stats)
+        timed("user_stats", mapped.user_stats)
+        popular = int(mapped.movie_index[0])
+        timed("ratings_of_movie", lambda: mapped.ratings_of_movie(popular), repeat=1000)
+        timed(f"co_rating_counts (movie {popular}, "
+              f"{len(mapped.ratings_of_movie(popular)[0])} raters)",
+              lambda: mapped.co_rating_counts(popular, 20), repeat=10)
+        del mapped
+
+
+if __name__ == "__main__":
+    main()
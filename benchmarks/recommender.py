@@ -0,0 +1,71 @@
+"""Benchmark building the item-item recommendation model.
+
+    $ python3 -m benchmarks.recommender --ratings 1000000 --users 50000 --movies 10000
+
+Generates synthetic (user, movie, score) triples with numpy, so no database
+is needed, then reports build time, the model's size and the peak memory
+traced while building, plus per-query latency for the two lookups.
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+import recommender
+
+
+def synthetic_ratings(rating_count, user_count, movie_count, seed):
+    """Return (user_ids, movie_ids, scores) with popular movies rated more."""
+
+    rng = np.random.default_rng(seed)
+    user_ids = rng.integers(1, user_count + 1, rating_count, dtype=np.int32)
+    # Zipf-ish popularity: low movie ids get most of the ratings.
+    movie_ids = (rng.pareto(1.2, rating_count) * movie_count / 20).astype(np.int64)
+    movie_ids = (movie_ids % movie_count + 1).astype(np.int32)
+    scores = rng.integers(0, 6, rating_count, dtype=np.int32)
+
+    # One rating per (user, movie), like the unique constraint guarantees.
+    pairs = user_ids.astype(np.int64) * (movie_count + 1) + movie_ids
+    _, first = np.unique(pairs, return_index=True)
+
+    return user_ids[first], movie_ids[first], scores[first]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the recommender build.")
+    parser.add_argument("--ratings", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--movies", type=int, default=10000)
+    parser.add_argument("--neighbors", type=int, default=recommender.NEIGHBORS)
+    parser.add_argument("--seed", type=int, default=29)
+    args = parser.parse_args(argv)
+
+    user_ids, movie_ids, scores = synthetic_ratings(
+        args.ratings, args.users, args.movies, args.seed)
+    print(f"{len(scores)} distinct ratings, {args.users} users, {args.movies} movies")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    model = recommender.ItemItemModel(user_ids, movie_ids, scores,
+                                      neighbors=args.neighbors)
+    build_seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"build: {build_seconds:.2f}s, model {model.nbytes / 2**20:.1f}MB, "
+          f"peak while building {peak / 2**20:.1f}MB")
+
+    for label, lookup, keys in (
+            ("similar_movies", model.similar_movies, movie_ids[:1000]),
+            ("recommend_for_user", model.recommend_for_user, user_ids[:1000])):
+        start = time.perf_counter()
+        for key in keys:
+            lookup(int(key))
+        per_query = (time.perf_counter() - start) / len(keys)
+        print(f"{label}: {per_query * 1e6:.0f}us per query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Benchmark a worker's cold start: import time and time to first byte.
+
+    $ python3 -m benchmarks.startup --db-uri postgresql:///ratings_bench
+
+Each run is a fresh interpreter that imports server, builds the app with
+create_app() and requests each of --paths once, timing every step up to
+the first byte of each response. Runs are repeated --runs times for each
+of three setups and the medians reported:
+
+- cold: templates compiled on first use, nothing warmed up;
+- precompiled: templates loaded from a cache filled by precompile_templates.py;
+- precompiled+warmup: the same, plus WARMUP (see warmup.py), which moves
+  work from the first requests into create_app().
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SETUPS = ("cold", "precompiled", "precompiled+warmup")
+
+
+def child(config, paths):
+    """Time one cold start in this (fresh) process; print the timings as JSON."""
+
+    started = time.perf_counter()
+    import server
+    imported = time.perf_counter()
+    app = server.create_app(config)
+    created = time.perf_counter()
+
+    timings = {"import": imported - started, "create_app": created - imported}
+
+    client = app.test_client()
+    for path in paths:
+        request_started = time.perf_counter()
+        response = client.get(path, buffered=False)
+        next(iter(response.response), b"")
+        timings[f"first byte of GET {path}"] = time.perf_counter() - request_started
+        response.close()
+
+    timings["total"] = time.perf_counter() - started
+
+    print(json.dumps(timings))
+
+
+def run(setup, db_uri, cache_dir, paths):
+    config = {"DATABASE_URI": db_uri}
+    if setup != "cold":
+        config["TEMPLATE_CACHE_DIR"] = cache_dir
+    config["WARMUP"] = setup == "precompiled+warmup"
+
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child", json.dumps(config),
+         "--paths", *paths],
+        check=True, capture_output=True, text=True).stdout
+
+    return json.loads(output.splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark cold starts.")
+    parser.add_argument("--db-uri", default="postgresql:///ratings_bench")
+    parser.add_argument("--paths", nargs="+", default=["/", "/movies"])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", metavar="CONFIG", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(json.loads(args.child), args.paths)
+        return
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        subprocess.run([sys.executable, "precompile_templates.py", cache_dir],
+                       check=True, capture_output=True,
+                       env=dict(os.environ, DATABASE_URI=args.db_uri))
+
+        for setup in SETUPS:
+            runs = [run(setup, args.db_uri, cache_dir, args.paths)
+                    for _ in range(args.runs)]
+            print(f"{setup}:")
+            for step in runs[0]:
+                milliseconds = statistics.median(timings[step] for timings in runs) * 1000
+                print(f"  {step:<32} {milliseconds:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
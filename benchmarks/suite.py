@@ -0,0 +1,258 @@
+"""Reproducible crud and HTTP benchmarks against a seeded database.
+
+    $ python3 -m benchmarks.suite --scale 100k --build --output after.json
+    $ python3 -m benchmarks.suite --scale 100k --output after.json --compare before.json
+
+--build (re)creates the database at --db-uri from benchmarks/datasets.py
+first. The benchmarks that write run after all the reads, and the
+database is rebuilt after them (unless --keep-writes), so every run
+starts from the same data. Each benchmark reports p50/p95/p99 latency, throughput and SQL
+statements per call. --output saves the results as JSON, and --compare
+prints the change against an earlier file, flagging p50 regressions
+beyond --threshold.
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import crud
+import model
+import recommender
+import server
+from benchmarks import datasets
+
+# Movies get_movie_by_id (warm) draws from, all loaded into the cache
+# first; well within movie_cache's 10,000 entries.
+WARM_MOVIES = 5000
+
+Benchmark = namedtuple("Benchmark", ["call", "prepare", "writes"], defaults=[None, False])
+"""call() is timed; prepare(), if any, runs once first; writes marks
+benchmarks that change the dataset."""
+
+_statements = [0]
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _count_statement(*args):
+    _statements[0] += 1
+
+
+@contextmanager
+def counting_queries():
+    """Yield a callable returning statements run since entering."""
+
+    start = _statements[0]
+    yield lambda: _statements[0] - start
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(benchmark, iterations, warmup=5):
+    """Run benchmark.call() iterations times and return its latency/query stats."""
+
+    if benchmark.prepare is not None:
+        benchmark.prepare()
+    for _ in range(min(warmup, iterations)):
+        benchmark.call()
+
+    latencies = []
+    with counting_queries() as queries:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            call_started = time.perf_counter()
+            benchmark.call()
+            latencies.append(time.perf_counter() - call_started)
+        elapsed = time.perf_counter() - started
+        query_count = queries()
+
+    latencies.sort()
+    return {
+        "iterations": iterations,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "throughput_per_s": iterations / elapsed,
+        "queries_per_call": query_count / iterations,
+    }
+
+
+def crud_benchmarks(rng, scale):
+    """Return {name: callable} for the crud microbenchmarks."""
+
+    users, movies, _ = datasets.SCALES[scale]
+
+    def random_movie():
+        return rng.randint(1, movies)
+
+    def random_user():
+        return rng.randint(1, users)
+
+    warm_ids = range(1, min(movies, WARM_MOVIES) + 1)
+
+    def load_warm_movies():
+        for movie_id in warm_ids:
+            crud.get_movie_by_id(movie_id)
+
+    def cold_movie_by_id():
+        crud.invalidate_movie_catalog()
+        crud.get_movie_by_id(random_movie())
+
+    def upsert_rating():
+        crud.upsert_rating(random_user(), random_movie(), rng.randint(0, 5))
+
+    return {
+        "crud.get_movies_page": Benchmark(lambda: crud.get_movies_page(
+            after=crud.encode_cursor(random_movie()))),
+        "crud.get_movie_by_id (warm)": Benchmark(
+            lambda: crud.get_movie_by_id(rng.choice(warm_ids)), prepare=load_warm_movies),
+        "crud.get_movie_by_id (cold)": Benchmark(cold_movie_by_id),
+        "crud.get_movies_with_ratings (one id)": Benchmark(
+            lambda: crud.get_movies_with_ratings([random_movie()])),
+        "crud.get_user_ratings_page": Benchmark(
+            lambda: crud.get_user_ratings_page(random_user())),
+        "crud.upsert_rating": Benchmark(upsert_rating, writes=True),
+    }
+
+
+def http_benchmarks(app, rng, scale):
+    """Return {name: callable} for the end-to-end benchmarks."""
+
+    users, movies, _ = datasets.SCALES[scale]
+    client = app.test_client()
+    client.post("/login", data={"email": "user0@test.com", "password": "test"})
+
+    def movie_details():
+        client.get(f"/movies/{rng.randint(1, movies)}")
+
+    def rate():
+        movie_id = rng.randint(1, movies)
+        with client.session_transaction() as session:
+            session["movie_id"] = movie_id
+        client.post("/rate", data={"rating": rng.randint(0, 5)},
+                    headers={"Referer": f"/movies/{movie_id}"})
+
+    def login():
+        client.post("/login", data={"email": f"user{rng.randrange(users)}@test.com",
+                                    "password": "test"})
+
+    return {
+        "GET /movies": Benchmark(lambda: client.get("/movies")),
+        "GET /movies/<id>": Benchmark(movie_details),
+        "POST /rate": Benchmark(rate, writes=True),
+        "POST /login": Benchmark(login),
+        "GET /user/<id>": Benchmark(lambda: client.get(f"/user/{rng.randint(1, users)}")),
+    }
+
+
+# Password hashing makes each login take ~100ms on purpose.
+ITERATION_OVERRIDES = {"POST /login": 20}
+
+
+def run(app, scale, iterations, seed):
+    """Run every benchmark, the ones that write last; return {name: stats}."""
+
+    rng = random.Random(seed)
+    crud_calls = crud_benchmarks(rng, scale)
+    http_calls = http_benchmarks(app, rng, scale)
+    results = {}
+
+    for writes in (False, True):
+        with app.app_context():
+            for name, benchmark in crud_calls.items():
+                if benchmark.writes == writes:
+                    results[name] = measure(benchmark,
+                                            ITERATION_OVERRIDES.get(name, iterations))
+                    model.db.session.remove()
+
+        for name, benchmark in http_calls.items():
+            if benchmark.writes == writes:
+                results[name] = measure(benchmark, ITERATION_OVERRIDES.get(name, iterations))
+
+    return results
+
+
+def print_results(results, baseline=None, threshold=0.10):
+    """Print a results table; with a baseline, return the regressed names."""
+
+    regressions = []
+    print(f"{'benchmark':<40} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'ops/s':>9} {'queries':>8}")
+    for name, stats in results.items():
+        line = (f"{name:<40} {stats['p50_ms']:8.2f} {stats['p95_ms']:8.2f} "
+                f"{stats['p99_ms']:8.2f} {stats['throughput_per_s']:9.1f} "
+                f"{stats['queries_per_call']:8.1f}")
+        old = (baseline or {}).get(name)
+        if old:
+            change = stats["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0
+            line += f"  p50 {change:+.0%}"
+            if change > threshold:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the crud and HTTP benchmarks.")
+    parser.add_argument("--scale", choices=sorted(datasets.SCALES), default="1k")
+    parser.add_argument("--db-uri", default="postgresql:///ratings_bench")
+    parser.add_argument("--build", action="store_true",
+                        help="(re)build the dataset before benchmarking")
+    parser.add_argument("--keep-writes", action="store_true",
+                        help="don't rebuild the dataset after the write benchmarks")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=datasets.SEED)
+    parser.add_argument("--output", help="save results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="p50 slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+
+    if args.build:
+        datasets.build(args.scale, args.db_uri)
+    # No background threads: the recommendations are built once, here,
+    # rather than while the benchmarks are being timed.
+    app = server.create_app({"DATABASE_URI": args.db_uri, "CACHE_INVALIDATION": False,
+                             "RECOMMENDER_REFRESH_SECONDS": 0})
+    with app.app_context():
+        recommender.rebuild()
+
+    results = run(app, args.scale, args.iterations, args.seed)
+    if not args.keep_writes:
+        datasets.build(args.scale, args.db_uri)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    regressions = print_results(results, baseline, args.threshold)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"scale": args.scale,
+                       "ratings": datasets.rating_count(args.scale),
+                       "iterations": args.iterations,
+                       "seed": args.seed,
+                       "python": platform.python_version(),
+                       "recorded_at": datetime.now().isoformat(timespec="seconds"),
+                       "results": results}, f, indent=2)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""Script to seed a benchmark-sized database in bulk.
+
+seed_database.py builds a small demo database through crud, one commit per
+row. This script builds databases of a chosen size in minutes instead:
+
+    $ python3 bulk_seed.py --users 100000 --movies 20000 --ratings-per-user 50
+
+Movies are streamed from data/movies.json and topped up with synthetic ones;
+users and ratings are generated on the fly. Rows are written in batches with
+COPY FROM STDIN on PostgreSQL (executemany anywhere else), and the same
+--seed always produces the same database.
+"""
+
+import argparse
+import csv
+import io
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+import crud
+import model
+import passwords
+import server
+
+MOVIES_PATH = "data/movies.json"
+
+WORDS = ("space", "love", "war", "family", "heist", "robot", "island", "ghost",
+         "detective", "dragon", "city", "summer", "secret", "journey", "night",
+         "king", "storm", "river", "friends", "revenge", "dream", "hunt")
+
+
+def iter_json_array(path, chunk_size=64 * 1024):
+    """Yield the items of a top-level JSON array without loading the file."""
+
+    decoder = json.JSONDecoder()
+
+    with open(path) as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} does not contain a JSON array")
+        buffer = buffer[1:]
+
+        while True:
+            buffer = buffer.lstrip().lstrip(",").lstrip()
+            if buffer.startswith("]"):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                more = f.read(chunk_size)
+                if not more:
+                    raise
+                buffer += more
+                continue
+            yield item
+            buffer = buffer[end:]
+
+
+def generate_movies(rng, count, movies_path=MOVIES_PATH):
+    """Yield movie rows: the real movies first, then synthetic ones."""
+
+    movie_id = 0
+    for movie in iter_json_array(movies_path):
+        if movie_id == count:
+            return
+        movie_id += 1
+        release_date = datetime.strptime(movie["release_date"], "%Y-%m-%d")
+        yield (movie_id, movie["title"], movie["overview"],
+               release_date, movie["poster_path"])
+
+    first_day = datetime(1950, 1, 1)
+    while movie_id < count:
+        movie_id += 1
+        release_date = first_day + timedelta(days=rng.randrange(365 * 75))
+        overview = " ".join(rng.choice(WORDS) for _ in range(12)).capitalize() + "."
+        yield (movie_id, f"Synthetic Movie {movie_id}", overview,
+               release_date, None)
+
+
+def generate_users(count):
+    """Yield user rows with unique, predictable emails.
+
+    Every user's password is 'test'. It is hashed once and the hash shared,
+    since hashing millions of times would dominate the load.
+    """
+
+    password_hash = passwords.hash_password("test")
+    for n in range(count):
+        yield (n + 1, f"user{n}@test.com", password_hash)
+
+
+def generate_ratings(rng, user_count, movie_count, ratings_per_user):
+    """Yield rating rows: ratings_per_user distinct movies for every user."""
+
+    for user_id in range(1, user_count + 1):
+        for movie_id in rng.sample(range(1, movie_count + 1), ratings_per_user):
+            yield (user_id, movie_id, rng.randint(0, 5))
+
+
+def batched(rows, size):
+    """Yield lists of up to size rows from an iterable."""
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_rows(table, columns, rows, batch_size):
+    """Write rows into table in batches and return how many were written."""
+
+    written = 0
+    engine = model.db.engine
+
+    if engine.dialect.name == "postgresql":
+        copy_sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for batch in batched(rows, batch_size):
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(batch)
+                buffer.seek(0)
+                cursor.copy_expert(copy_sql, buffer)
+                connection.commit()
+                written += len(batch)
+        finally:
+            connection.close()
+        return written
+
+    insert = model.db.metadata.tables[table].insert()
+    for batch in batched(rows, batch_size):
+        with engine.begin() as connection:
+            connection.execute(insert, [dict(zip(columns, row)) for row in batch])
+        written += len(batch)
+
+    return written
+
+
+def reset_id_sequences():
+    """Move the serial sequences past the ids we wrote explicitly."""
+
+    if model.db.engine.dialect.name != "postgresql":
+        return
+
+    with model.db.engine.begin() as connection:
+        for table, column in (("users", "user_id"), ("movies", "movie_id")):
+            connection.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), "
+                f"COALESCE(MAX({column}), 1)) FROM {table}"))
+
+
+def timed_load(label, table, columns, rows, batch_size):
+    """Load rows and print the rate they went in at."""
+
+    start = time.perf_counter()
+    written = load_rows(table, columns, rows, batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {written} rows in {elapsed:.1f}s "
+          f"({written / max(elapsed, 1e-9):,.0f} rows/s)")
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Seed a benchmark-sized ratings database.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--movies", type=int, default=1000,
+                        help="total movies, real ones from movies.json first")
+    parser.add_argument("--ratings-per-user", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=29,
+                        help="RNG seed, so runs are reproducible")
+    parser.add_argument("--db-uri", default="postgresql:///ratings")
+    parser.add_argument("--keep", action="store_true",
+                        help="don't drop and recreate the tables first")
+    args = parser.parse_args(argv)
+
+    if args.ratings_per_user > args.movies:
+        parser.error("--ratings-per-user can't exceed --movies")
+
+    rng = random.Random(args.seed)
+    app = server.create_app({"DATABASE_URI": args.db_uri})
+
+    with app.app_context():
+        if not args.keep:
+            model.db.drop_all()
+        model.db.create_all()
+
+        start = time.perf_counter()
+
+        timed_load("movies", "movies",
+                   ("movie_id", "title", "overview", "release_date", "poster_path"),
+                   generate_movies(rng, args.movies), args.batch_size)
+        timed_load("users", "users", ("user_id", "email", "password_hash"),
+                   generate_users(args.users), args.batch_size)
+        total = timed_load("ratings", "ratings", ("user_id", "movie_id", "score"),
+                           generate_ratings(rng, args.users, args.movies,
+                                            args.ratings_per_user),
+                           args.batch_size)
+        reset_id_sequences()
+
+        summary_start = time.perf_counter()
+        crud.rebuild_movie_rating_stats()
+        print(f"movie rating summaries: {time.perf_counter() - summary_start:.1f}s")
+
+        # Cached movies (if the cache is shared) are from the old database:
+        crud.invalidate_movie_catalog()
+
+        elapsed = time.perf_counter() - start
+        print(f"Seeded {total} ratings in {elapsed:.1f}s "
+              f"({total / max(elapsed, 1e-9):,.0f} ratings/s overall)")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
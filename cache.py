@@ -0,0 +1,214 @@
+"""Read-through caching for catalog data.
+
+A Cache sits in front of a backend that actually holds the values:
+
+    LRUBackend        in-process, bounded by size and TTL (the default)
+    MemcachedBackend  a pymemcache-style client (get/set(expire=)/delete)
+    RedisBackend      a redis-py-style client (get/set(ex=)/delete)
+
+Only plain, picklable values (dicts, tuples) should be cached, never ORM
+instances; crud turns cached movie dicts back into Movie objects.
+
+Namespace versions (see Cache.bump) are kept by the backend too, so every
+process sharing a memcached or redis backend sees the same versions.
+"""
+
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUBackend:
+    """An in-process LRU cache with a size bound and per-entry TTL."""
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        # Versions are kept: a loader that started before the clear must
+        # not find its old version current again.
+        with self._lock:
+            self._entries.clear()
+
+    def version(self, namespace):
+        return self._versions.get(namespace, 0)
+
+    def bump_version(self, namespace):
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+
+    def stats(self):
+        return {"size": len(self._entries), "maxsize": self.maxsize,
+                "evictions": self.evictions}
+
+
+class MemcachedBackend:
+    """Store entries in memcached (or anything speaking its client API)."""
+
+    def __init__(self, client, ttl=300, prefix="ratings:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, key):
+        # Hashed: a repr can hold spaces and control characters, or run
+        # past memcached's 250-byte key limit.
+        return self.prefix + hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def _version_key(self, namespace):
+        return f"{self.prefix}version:{namespace}"
+
+    def version(self, namespace):
+        raw = self.client.get(self._version_key(namespace))
+        return 0 if raw is None else int(raw)
+
+    def bump_version(self, namespace):
+        key = self._version_key(namespace)
+        # incr only works on an existing key; add only creates a missing one.
+        if self.client.incr(key, 1, noreply=False) is None:
+            if not self.client.add(key, b"1", expire=0, noreply=False):
+                self.client.incr(key, 1, noreply=False)
+
+    def get(self, key):
+        raw = self.client.get(self._key(key))
+        return MISSING if raw is None else pickle.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self._key(key), pickle.dumps(value), expire=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        self.client.flush_all()
+
+    def stats(self):
+        return {}
+
+
+class RedisBackend(MemcachedBackend):
+    """Store entries in redis (or a redis-compatible server)."""
+
+    def set(self, key, value):
+        self.client.set(self._key(key), pickle.dumps(value), ex=self.ttl)
+
+    def bump_version(self, namespace):
+        self.client.incr(self._version_key(namespace))
+
+    def clear(self):
+        versions = self._version_key("")
+        for key in self.client.scan_iter(self.prefix + "*"):
+            name = key.decode() if isinstance(key, bytes) else key
+            if not name.startswith(versions):  # see LRUBackend.clear
+                self.client.delete(key)
+
+
+class Cache:
+    """Read-through cache with hit/miss counters and namespace versions.
+
+    Keys are tuples whose first item is a namespace, like ("movie", 42).
+    bump(namespace) invalidates every key in a namespace at once by
+    changing the version folded into those keys; entries under the old
+    version just age out of the backend. The versions are stored in the
+    backend, so a bump is seen by every process sharing it.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or LRUBackend()
+        self.hits = 0
+        self.misses = 0
+
+    def _versioned(self, key):
+        return (self.backend.version(key[0]),) + tuple(key)
+
+    def get(self, key):
+        """Return the cached value for key, or MISSING."""
+
+        return self._get(self._versioned(key))
+
+    def _get(self, versioned_key):
+        value = self.backend.get(versioned_key)
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(self._versioned(key), value)
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, calling loader() on a miss.
+
+        A loader returning None is not cached, so lookups of rows that
+        don't exist yet keep going to the database. The value is stored
+        under the version read before loading it, so if the namespace is
+        bumped meanwhile, it lands where nothing will read it.
+        """
+
+        versioned_key = self._versioned(key)
+        value = self._get(versioned_key)
+        if value is MISSING:
+            value = loader()
+            if value is not None:
+                self.backend.set(versioned_key, value)
+        return value
+
+    def delete(self, key):
+        self.backend.delete(self._versioned(key))
+
+    def bump(self, namespace):
+        self.backend.bump_version(namespace)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        """Return the counters as a dict (backend stats included)."""
+
+        return dict(self.backend.stats(), hits=self.hits, misses=self.misses)
+
+    def metrics(self, prefix):
+        """Return stats() as metrics for instrumentation.register_collector."""
+
+        stats = self.stats()
+        metrics = [(f"{prefix}_{key}_total", f"Cache {key}.", "counter", [({}, stats[key])])
+                   for key in ("hits", "misses", "evictions") if key in stats]
+        if "size" in stats:
+            metrics.append((f"{prefix}_entries", "Entries currently cached.", "gauge",
+                            [({}, stats["size"])]))
+        return metrics
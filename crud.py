@@ -1,6 +1,79 @@
 """CRUD operations."""
 
-from model import db, User, Movie, Rating, connect_to_db
+import base64
+import math
+from collections import namedtuple
+
+from datetime import datetime
+
+from sqlalchemy import case, event, func, literal_column, or_, text
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+
+import cache
+import invalidation
+import passwords
+import search
+from model import (db, User, Movie, Rating, RoutingSession, SCORES, next_version,
+                   reading_from_primary, replica_read, trending_key_at)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_SEARCH_RESULTS = 1000  # how deep search results can be paged
+
+Page = namedtuple("Page", ["items", "prev_cursor", "next_cursor"])
+"""One page of a listing. The cursors are opaque tokens for ?before= and
+?after=, or None when there is no page in that direction."""
+
+MovieListing = namedtuple("MovieListing",
+                          ["movie_id", "title", "average_rating", "rating_count",
+                           "version"])
+
+RatingStats = namedtuple("RatingStats",
+                         ["movie_id", "rating_count", "average_rating", "stddev",
+                          "median", "histogram"])
+"""A movie's score distribution: histogram counts ratings per score 0-5.
+average_rating, stddev and median are None for an unrated movie."""
+
+ImportedRating = namedtuple("ImportedRating",
+                            ["line", "user_id", "email", "movie_id", "score"])
+"""One row of a bulk import (see import_ratings). The user is given by
+user_id or, if that is None, by email; line is where the row came from,
+for error reports."""
+
+# Movie rows (as plain dicts) and rendered listings are read through this
+# cache. Each process keeps its own copy, kept coherent with the others
+# by invalidation.py's listener; or swap the backend to share one, e.g.
+#   crud.movie_cache.backend = cache.RedisBackend(redis.Redis())
+#
+# Cache misses are always loaded from the primary: a lagging replica
+# could put back a row that a write had just evicted, and everyone --
+# the writer included -- would be served it for the whole TTL.
+movie_cache = cache.Cache(cache.LRUBackend(maxsize=10000, ttl=300))
+
+
+_CATALOG_CHANGED = "catalog_changed"  # session.info key set by create_movie
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _bump_catalog(session):
+    if session.info.pop(_CATALOG_CHANGED, False):
+        movie_cache.bump("catalog")
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _forget_catalog_change(session):
+    session.info.pop(_CATALOG_CHANGED, None)
+
+
+def _cached(key, loader):
+    """movie_cache.get_or_load(key, loader), loading from the primary."""
+
+    def load_from_primary():
+        with reading_from_primary():
+            return loader()
+
+    return movie_cache.get_or_load(key, load_from_primary)
+
 
 def create_user(email, password):
     """Create and return a new user.
@@ -46,25 +119,51 @@ def create_user(email, password):
     >> 
     """
 
-    user = User(email=email, password=password)
+    user = User(email=email, password_hash=passwords.hash_password(password))
 
     db.session.add(user)
     db.session.commit()
     
     return user
 
+@replica_read
 def get_users():
     """Return all users."""
 
     return User.query.all()
 
 
+@replica_read
+def get_users_page(after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """Return a Page of user ids, keyed on user_id.
+
+    Only the user_id column is loaded; see _keyset_page for the cursors.
+    """
+
+    return _keyset_page(db.session.query(User.user_id), User.user_id,
+                        after=after, before=before, limit=limit)
+
+
+@replica_read
 def get_user_by_id(user_id):
     """Return a user by primary key."""
 
     return User.query.get(user_id)
 
 
+@replica_read
+def get_users_by_ids(user_ids):
+    """Return {user_id: user} for user_ids, in one query."""
+
+    return {user.user_id: user for user in User.query.filter(User.user_id.in_(user_ids))}
+
+
+def get_users_by_emails(emails):
+    """Return {email: user} for emails, in one query."""
+
+    return {user.email: user for user in User.query.filter(User.email.in_(emails))}
+
+
 def get_user_by_email(email):
     """Return a user by email."""
 
@@ -80,15 +179,24 @@ def does_this_user_exist_already(email):
         return False
 
 
+def authenticate_user(email, password):
+    """Return the user with this email and password, or None.
+
+    One lookup on the unique email index, then a salted hash check.
+    """
+
+    user = get_user_by_email(email)
+
+    if user and passwords.check_password(user.password_hash, password):
+        return user
+
+    return None
+
+
 def does_the_password_match(email, password):
     """Return a boolean we can use for the if-statement in server.py."""
 
-    if User.query.filter(User.email == email).first() and (
-        User.query.filter(User.password == password).first()):
-            return True
-            # return User.query.filter(User.email == email).first()
-    else:
-        return False
+    return authenticate_user(email, password) is not None
 
 
 def create_movie(title, overview, release_date=None, poster_path=None):
@@ -137,47 +245,545 @@ def create_movie(title, overview, release_date=None, poster_path=None):
     movie = Movie(title = title, overview = overview, \
         release_date = release_date, poster_path = poster_path)
 
+    # The new movie belongs in every cached listing (in every process),
+    # once it's committed:
+    db.session.info[_CATALOG_CHANGED] = True
+    invalidation.changed()
+
     return movie
     
 
+@replica_read
 def get_movies():
-    """Return all movies."""
+    """Return all movies (through the movie cache)."""
+
+    movie_rows = _cached(
+        ("catalog", "all"),
+        lambda: [_movie_row(movie) for movie in Movie.query.order_by(Movie.movie_id)])
+
+    return [_movie_from_row(row) for row in movie_rows]
+
+
+@replica_read
+def get_movies_page(after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """Return a Page of MovieListings, keyed on movie_id.
+
+    Loads just the columns the listing shows, so the cost of a page does
+    not depend on how many movies there are. Pages are cached until the
+    catalog or a rating changes.
+    """
+
+    return _cached(
+        ("catalog", "page", after, before, limit),
+        lambda: _load_movies_page(after, before, limit))
+
+
+def _load_movies_page(after, before, limit):
+
+    query = db.session.query(
+        Movie.movie_id, Movie.title, Movie.rating_sum, Movie.rating_count,
+        Movie.version)
+
+    page = _keyset_page(query, Movie.movie_id,
+                        after=after, before=before, limit=limit)
+
+    listings = [MovieListing(row.movie_id, row.title,
+                             _average(row.rating_sum, row.rating_count),
+                             row.rating_count, row.version)
+                for row in page.items]
+
+    return page._replace(items=listings)
+
+
+def _average(rating_sum, rating_count):
+    """Round an average score for display, the same way Movie does."""
+
+    if not rating_count:
+        return 0.0
+
+    return round(float(rating_sum) / rating_count, 1)
+
+
+def encode_cursor(key):
+    """Turn a primary key into an opaque page cursor."""
+
+    return base64.urlsafe_b64encode(str(key).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Turn a page cursor back into a primary key.
+
+    Raises ValueError for anything encode_cursor() didn't produce.
+    """
+
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, UnicodeDecodeError) as error:
+        raise ValueError(f"Invalid page cursor: {cursor!r}") from error
+
 
-    return Movie.query.all()
+def _keyset_page(query, key_column, after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """Return one Page of query, ordered by key_column.
 
+    Pages seek on the key (WHERE key > :after) instead of using OFFSET, so
+    every page costs the same. One extra row is fetched to find out whether
+    there is another page in the direction we're going.
+    """
+
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    def cursor_for(row):
+        return encode_cursor(getattr(row, key_column.key))
+
+    if before is not None:
+        rows = query.filter(key_column < decode_cursor(before)).order_by(
+            key_column.desc()).limit(limit + 1).all()
+        has_prev = len(rows) > limit
+        rows = rows[:limit][::-1]
+        prev_cursor = cursor_for(rows[0]) if has_prev else None
+        next_cursor = cursor_for(rows[-1]) if rows else None
+        return Page(rows, prev_cursor, next_cursor)
+
+    if after is not None:
+        query = query.filter(key_column > decode_cursor(after))
+
+    rows = query.order_by(key_column).limit(limit + 1).all()
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+    prev_cursor = cursor_for(rows[0]) if after is not None and rows else None
+    next_cursor = cursor_for(rows[-1]) if has_next else None
+
+    return Page(rows, prev_cursor, next_cursor)
+
+
+@replica_read
+def get_columns_page(columns, key_column, *criteria, joins=(),
+                     after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """Return a Page of rows of just these columns, keyed on key_column.
+
+    The rows are plain tuples, not ORM objects, so only the columns asked
+    for are read and nothing is hydrated. key_column must be one of
+    columns; criteria filter the rows and joins (relationships) bring in
+    columns of other tables.
+    """
+
+    query = db.session.query(*columns).select_from(key_column.class_)
+    for join in joins:
+        query = query.join(join)
+
+    return _keyset_page(query.filter(*criteria), key_column,
+                        after=after, before=before, limit=limit)
+
+
+@replica_read
+def get_columns_row(columns, *criteria):
+    """Return the first row of just these columns matching criteria, or None."""
+
+    return db.session.query(*columns).filter(*criteria).first()
+
+
+@replica_read
 def get_movie_by_id(movie_id):
-    """Return one movie."""
-    
-    return Movie.query.get(movie_id)
+    """Return one movie (through the movie cache)."""
+
+    movie_row = _cached(
+        ("movie", int(movie_id)), lambda: _movie_row(Movie.query.get(movie_id)))
+
+    return _movie_from_row(movie_row)
+
+
+@replica_read
+def get_movies_in_order(movie_ids):
+    """Return the movies for movie_ids, in that order (through the cache)."""
+
+    movies_by_id = get_movies_by_ids(list(dict.fromkeys(movie_ids)))
+
+    return [movies_by_id[movie_id] for movie_id in movie_ids
+            if movie_id in movies_by_id]
+
+
+@replica_read
+def get_movies_by_ids(movie_ids):
+    """Return {movie_id: movie} for movie_ids, loading cache misses in one query."""
+
+    movie_rows = {}
+    for movie_id in movie_ids:
+        movie_row = movie_cache.get(("movie", movie_id))
+        if movie_row is not cache.MISSING:
+            movie_rows[movie_id] = movie_row
+
+    missing = [movie_id for movie_id in movie_ids if movie_id not in movie_rows]
+    if missing:
+        with reading_from_primary():  # they're going into the cache
+            movies = Movie.query.filter(Movie.movie_id.in_(missing)).all()
+        for movie in movies:
+            movie_rows[movie.movie_id] = _movie_row(movie)
+            movie_cache.set(("movie", movie.movie_id), movie_rows[movie.movie_id])
+
+    return {movie_id: _movie_from_row(movie_row)
+            for movie_id, movie_row in movie_rows.items()}
+
+
+def _movie_row(movie):
+    """Return a movie's columns as a plain dict we can cache."""
+
+    if movie is None:
+        return None
+
+    return {column.key: getattr(movie, column.key)
+            for column in Movie.__table__.columns}
+
+
+def _movie_from_row(movie_row):
+    """Attach a cached movie dict to the session as a Movie, without a query."""
+
+    if movie_row is None:
+        return None
+
+    movie = Movie(**movie_row)
+    make_transient_to_detached(movie)
+
+    return db.session.merge(movie, load=False)
+
+
+def invalidate_movie(movie_id):
+    """Forget cached data for a movie whose row (or ratings) just changed."""
+
+    movie_cache.delete(("movie", movie_id))
+    movie_cache.bump("catalog")
+
+
+def invalidate_movie_catalog():
+    """Forget everything in the movie cache, e.g. after reseeding."""
+
+    movie_cache.clear()
+
+
+def evict_movies(movie_ids, everything=False):
+    """Forget cached data for movies changed by another process.
+
+    The evict callback of invalidation.start_listener.
+    """
+
+    if everything:
+        invalidate_movie_catalog()
+        return
+
+    for movie_id in movie_ids:
+        movie_cache.delete(("movie", movie_id))
+    movie_cache.bump("catalog")
+
+@replica_read
+def get_catalog_version():
+    """Return a number that changes whenever any movie or rating does.
+
+    That's the newest movie version, read off the end of its index.
+    """
+
+    return db.session.query(func.max(Movie.version)).scalar() or 0
+
+
+@replica_read
+def get_movie_version(movie_id):
+    """Return one movie's version, or None if there's no such movie."""
+
+    return db.session.query(Movie.version).filter(Movie.movie_id == movie_id).scalar()
+
+
+@replica_read
+def get_user_version(user_id):
+    """Return one user's version, or None if there's no such user."""
+
+    return db.session.query(User.version).filter(User.user_id == user_id).scalar()
+
 
 def get_movie_rating(movie_instance):
-    """Return the average of all ratings for one movie."""
-    
-    ratings_objects = Rating.query.filter(Rating.movie == movie_instance)
+    """Return the average of all ratings for one movie.
 
-    # This is the stupid way until I can get the fancy way working:
-    # average_rating = Rating.query.with_entities(func.avg(Rating.score)).filter(Rating.movie == movie_instance)
+    Reads the rating summary stored on the movie, so this no longer
+    touches the ratings table at all.
+    """
+
+    return movie_instance.average_rating, movie_instance.rating_count
 
-    total_scores = 0
-    count_scores = 0
-    for rating in ratings_objects:
-        total_scores += rating.score
-        count_scores += 1
 
-    if count_scores > 0:
-        average_rating = round(float(total_scores)/count_scores, 1)
+@replica_read
+def get_movies_with_ratings(movie_ids=None):
+    """Return (movie, average_rating, rating_count) tuples for many movies.
+
+    Averages and counts are read from each movie's rating summary, through
+    the movie cache; misses are loaded in a single query. Pass movie_ids to
+    restrict the result to a subset of movies.
+    """
+
+    if movie_ids is None:
+        movies = get_movies()
     else:
-        average_rating = 0.0
+        movies_by_id = get_movies_by_ids(sorted({int(movie_id) for movie_id in movie_ids}))
+        movies = list(movies_by_id.values())
+
+    return [(movie, movie.average_rating, movie.rating_count)
+            for movie in movies]
+
+
+def rating_stats(movie):
+    """Return a movie's RatingStats, from its stored score histogram."""
+
+    histogram = movie.score_histogram
+    count = sum(histogram)
+    if not count:
+        return RatingStats(movie.movie_id, 0, None, None, None, histogram)
+
+    mean = sum(score * n for score, n in zip(SCORES, histogram)) / count
+    variance = sum(n * (score - mean) ** 2 for score, n in zip(SCORES, histogram)) / count
+
+    def nth_score(n):
+        """The n-th smallest score (from 0)."""
+        for score, seen in zip(SCORES, _running_total(histogram)):
+            if seen > n:
+                return score
+
+    median = (nth_score((count - 1) // 2) + nth_score(count // 2)) / 2
+
+    return RatingStats(movie.movie_id, count, round(mean, 2),
+                       round(math.sqrt(variance), 2), median, histogram)
+
+
+def _running_total(numbers):
+    total = 0
+    for number in numbers:
+        total += number
+        yield total
+
+
+@replica_read
+def get_rating_stats(movie_ids):
+    """Return {movie_id: RatingStats} for many movies.
+
+    Read from the histograms stored on each movie, through the movie
+    cache, so this is one IN query at most whatever the number of movies
+    or ratings. Unknown movie_ids are left out.
+    """
+
+    movies_by_id = get_movies_by_ids(sorted({int(movie_id) for movie_id in movie_ids}))
+
+    return {movie_id: rating_stats(movie) for movie_id, movie in movies_by_id.items()}
+
+
+@replica_read
+def get_user_ratings_page(user_id, after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """Return a Page of one user's Ratings, keyed on rating_id.
+
+    Each rating's movie (title and rating summary, so its current average)
+    is joined into the same query, so a page is one query however many
+    movies the user has rated.
+    """
+
+    query = Rating.query.options(joinedload(Rating.movie)).filter(
+        Rating.user_id == user_id)
+
+    return _keyset_page(query, Rating.rating_id,
+                        after=after, before=before, limit=limit)
+
+
+@replica_read
+def get_top_movies(limit=100):
+    """Return the top-rated movies by Bayesian average, best first.
+
+    Reads the top of the ix_movies_bayesian_score index, so this costs
+    O(limit) however many movies and ratings there are.
+    """
+
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    return _cached(
+        ("catalog", "top", limit),
+        lambda: _load_ranked_movies(Movie.bayesian_score.desc(), limit))
+
+
+@replica_read
+def get_trending_movies(limit=100):
+    """Return the movies rated most in the last day or so, hottest first."""
+
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    return _cached(
+        ("catalog", "trending", limit),
+        lambda: _load_ranked_movies(Movie.trending_key.desc(), limit))
+
+
+def _load_ranked_movies(order, limit):
+    movies = Movie.query.order_by(order, Movie.movie_id).limit(limit).all()
+    now = datetime.now()
+
+    return [{"movie_id": movie.movie_id, "title": movie.title,
+             "average_rating": movie.average_rating, "rating_count": movie.rating_count,
+             "bayesian_score": round(movie.bayesian_score, 2),
+             "recent_ratings": round(movie.recent_ratings(now), 1)}
+            for movie in movies]
+
+
+@replica_read
+def search_movies(query, after=None, before=None, limit=DEFAULT_PAGE_SIZE):
+    """Return a Page of MovieListings matching query, best match first.
+
+    Matches are ranked, not keyed, so the cursors are result offsets
+    (capped at MAX_SEARCH_RESULTS). On PostgreSQL this uses the
+    search_vector and title trigram indexes; elsewhere the in-process
+    search.SearchIndex. Pages are cached like the catalog listing.
+    """
+
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    if after is not None:
+        offset = max(0, decode_cursor(after))
+    elif before is not None:
+        offset = max(0, decode_cursor(before) - limit)
+    else:
+        offset = 0
+
+    if not search.tokenize(query) or offset >= MAX_SEARCH_RESULTS:
+        return Page([], None, None)
+
+    return _cached(
+        ("catalog", "search", query, offset, limit),
+        lambda: _load_search_page(query, offset, limit))
+
+
+def _load_search_page(query, offset, limit):
+    columns = (Movie.movie_id, Movie.title, Movie.rating_sum, Movie.rating_count,
+               Movie.version)
+
+    if db.engine.dialect.name == "postgresql":
+        tsquery = func.to_tsquery("english", search.to_tsquery(query))
+        search_vector = literal_column("movies.search_vector")
+        rank = (func.ts_rank(search_vector, tsquery)
+                + func.word_similarity(query, Movie.title))
+        rows = db.session.query(*columns).filter(
+            or_(search_vector.op("@@")(tsquery), Movie.title.op("%>")(query))).order_by(
+            rank.desc(), Movie.movie_id).offset(offset).limit(limit + 1).all()
+    else:
+        movie_ids = search.get_index().search(query, offset + limit + 1)[offset:]
+        rows_by_id = {row.movie_id: row for row in db.session.query(*columns).filter(
+            Movie.movie_id.in_(movie_ids))}
+        rows = [rows_by_id[movie_id] for movie_id in movie_ids if movie_id in rows_by_id]
+
+    has_next = len(rows) > limit and offset + limit < MAX_SEARCH_RESULTS
+    listings = [MovieListing(row.movie_id, row.title,
+                             _average(row.rating_sum, row.rating_count),
+                             row.rating_count, row.version)
+                for row in rows[:limit]]
+
+    return Page(listings,
+                encode_cursor(offset) if offset else None,
+                encode_cursor(offset + limit) if has_next else None)
+
+
+def _apply_rating_delta(movie_id, old_score, new_score, user_id=None):
+    """Adjust one movie's rating summary for a rating change.
+
+    old_score is None for a brand new rating (and new_score is None for a
+    removed one). Issues a single UPDATE using column arithmetic, which
+    also bumps the movie's version (and the rating user's, if user_id is
+    given); the caller owns the transaction and commits it together with
+    the rating.
+    """
+
+    if old_score == new_score:
+        return
+
+    changes = {}
+    if old_score is None:
+        changes[Movie.rating_count] = Movie.rating_count + 1
+    elif new_score is None:
+        changes[Movie.rating_count] = Movie.rating_count - 1
+
+    changes[Movie.rating_sum] = Movie.rating_sum + (new_score or 0) - (old_score or 0)
+
+    if old_score is not None:
+        changes[Movie.score_column(old_score)] = Movie.score_column(old_score) - 1
+    if new_score is not None:
+        changes[Movie.score_column(new_score)] = Movie.score_column(new_score) + 1
+
+    # trending_key = log(e^trending_key + e^now_key), computed stably.
+    # (Far-apart keys skip the EXP, which PostgreSQL would underflow on.)
+    now_key = trending_key_at(datetime.now())
+    larger = func.greatest(Movie.trending_key, now_key)
+    gap = func.abs(Movie.trending_key - now_key)
+    changes[Movie.trending_key] = case(
+        (gap > 30, larger), else_=larger + func.ln(1 + func.exp(-gap)))
+
+    dialect_name = db.engine.dialect.name
+    changes[Movie.version] = next_version(dialect_name)
+
+    Movie.query.filter(Movie.movie_id == movie_id).update(
+        changes, synchronize_session=False)
+
+    if user_id is not None:
+        User.query.filter(User.user_id == user_id).update(
+            {User.version: next_version(dialect_name)}, synchronize_session=False)
+
+
+def compute_movie_rating_stats():
+    """Return {movie_id: stats} recomputed from the ratings table.
+
+    stats is a dict holding rating_count, rating_sum and score_N_count,
+    the same keys as the summary columns on Movie. Movies with no ratings
+    are left out.
+    """
 
-    return average_rating, count_scores
+    histogram_columns = [
+        func.sum(case((Rating.score == score, 1), else_=0)) for score in SCORES]
 
-"""
-def update_movie_ratings():
+    rows = db.session.query(
+        Rating.movie_id, func.count(Rating.rating_id), func.sum(Rating.score),
+        *histogram_columns).group_by(Rating.movie_id)
+
+    all_stats = {}
+    for movie_id, rating_count, rating_sum, *histogram in rows:
+        stats = {"rating_count": rating_count, "rating_sum": rating_sum}
+        for score in SCORES:
+            stats[f"score_{score}_count"] = histogram[score]
+        all_stats[movie_id] = stats
+
+    return all_stats
+
+
+def rebuild_movie_rating_stats(verify_only=False):
+    """Recompute every movie's rating summary from the ratings table.
+
+    Returns the list of movie_ids whose stored summary had drifted. Unless
+    verify_only is set, those movies are rewritten in one bulk update.
+    """
+
+    empty_stats = {"rating_count": 0, "rating_sum": 0}
+    for score in SCORES:
+        empty_stats[f"score_{score}_count"] = 0
+
+    all_stats = compute_movie_rating_stats()
+    stat_names = list(empty_stats)
+
+    stored = db.session.query(
+        Movie.movie_id, *[getattr(Movie, name) for name in stat_names])
+
+    drifted = []
+    for movie_id, *stored_values in stored:
+        stats = all_stats.get(movie_id, empty_stats)
+        if stored_values != [stats[name] for name in stat_names]:
+            drifted.append(dict(stats, movie_id=movie_id))
+
+    if drifted and not verify_only:
+        version = db.session.scalar(db.select(next_version(db.engine.dialect.name)))
+        for stats in drifted:
+            stats["version"] = version
+        db.session.bulk_update_mappings(Movie, drifted)
+        invalidation.changed(everything=True)
+        db.session.commit()
+        invalidate_movie_catalog()
+
+    return [stats["movie_id"] for stats in drifted]
 
-    for each_movie_instance in get_movies():
-        average_rating = get_movie_rating(each_movie_instance)
-# We can't do this without a schema change.
-"""
 
 def create_rating(user_instance, movie_instance, score: int):
     """Create and return a new rating.
@@ -225,14 +831,332 @@ def create_rating(user_instance, movie_instance, score: int):
     """
     rating = Rating(user = user_instance, movie = movie_instance, score = score)
     db.session.add(rating)
+    _apply_rating_delta(movie_instance.movie_id, None, score, user_instance.user_id)
+    invalidation.changed([movie_instance.movie_id])
     db.session.commit()
+    invalidate_movie(movie_instance.movie_id)
 
     return rating
     
 def update_rating(user_instance, movie_instance, new_score: int):
-    db.session.query(Rating).filter(Rating.movie == movie_instance, Rating.user == user_instance).update({Rating.score: new_score})
+    # Update the existing row in place. (Building a fresh Rating here would
+    # get cascaded into the session through the backrefs and inserted as a
+    # duplicate on the next commit.)
+    rating = Rating.query.filter(Rating.movie == movie_instance, Rating.user == user_instance).first()
+    old_score = rating.score
+    rating.score = new_score
+    _apply_rating_delta(movie_instance.movie_id, old_score, new_score,
+                        user_instance.user_id)
+    invalidation.changed([movie_instance.movie_id])
+    db.session.commit()
+    invalidate_movie(movie_instance.movie_id)
+    return rating
+
+_SCORE_DELTA_SQL = ",\n        ".join(
+    f"score_{score}_count = score_{score}_count"
+    f" + CASE WHEN :score = {score} THEN 1 ELSE 0 END"
+    f" - CASE WHEN delta.old_score = {score} THEN 1 ELSE 0 END"
+    for score in SCORES)
+
+# Locks the rating, if there is one, before _UPSERT_RATING_SQL runs. The
+# upsert's own snapshot can't be trusted for the previous score: a
+# concurrent writer may change (or insert) the row while the upsert waits
+# on it. With the row locked first, the upsert's snapshot (taken after the
+# lock is granted, under READ COMMITTED) has its latest score.
+_LOCK_RATING_SQL = text("""
+SELECT score FROM ratings
+WHERE user_id = :user_id AND movie_id = :movie_id
+FOR UPDATE
+""")
+
+# The rating write, the movie summary delta, the movie and user version
+# bumps and the lookup of the previous score all happen in this one
+# statement. xmax = 0 on the returned row
+# means it was freshly inserted rather than updated. A row that was
+# updated but wasn't there to lock was inserted by a concurrent
+# transaction that committed while we waited: its previous score is
+# unknown, so the summary is left alone and raced is returned, for the
+# caller to roll back and retry (see _execute_upsert).
+_UPSERT_RATING_SQL = text(f"""
+WITH previous AS (
+    SELECT score FROM ratings
+    WHERE user_id = :user_id AND movie_id = :movie_id
+), upserted AS (
+    INSERT INTO ratings (user_id, movie_id, score)
+    VALUES (:user_id, :movie_id, :score)
+    ON CONFLICT (user_id, movie_id) DO UPDATE SET score = EXCLUDED.score
+    RETURNING (xmax = 0) AS inserted
+), delta AS (
+    SELECT CASE WHEN upserted.inserted THEN NULL
+                ELSE (SELECT score FROM previous) END AS old_score,
+           NOT upserted.inserted AND NOT EXISTS (SELECT 1 FROM previous) AS raced
+    FROM upserted
+), summary AS (
+    UPDATE movies SET
+        rating_count = rating_count + CASE WHEN delta.old_score IS NULL THEN 1 ELSE 0 END,
+        rating_sum = rating_sum + :score - COALESCE(delta.old_score, 0),
+        {_SCORE_DELTA_SQL},
+        trending_key = CASE
+            WHEN ABS(trending_key - :trending_key) > 30
+            THEN GREATEST(trending_key, :trending_key)
+            ELSE GREATEST(trending_key, :trending_key)
+                 + LN(1 + EXP(-ABS(trending_key - :trending_key)))
+        END,
+        version = nextval('resource_version_seq')
+    FROM delta
+    WHERE movies.movie_id = :movie_id
+      AND delta.old_score IS DISTINCT FROM :score
+      AND NOT delta.raced
+), user_version AS (
+    UPDATE users SET version = nextval('resource_version_seq')
+    FROM delta
+    WHERE users.user_id = :user_id
+      AND delta.old_score IS DISTINCT FROM :score
+      AND NOT delta.raced
+)
+SELECT delta.old_score, movies.title, delta.raced
+FROM delta, movies
+WHERE movies.movie_id = :movie_id
+""")
+
+
+UPSERT_ATTEMPTS = 3
+
+
+def _execute_upsert(lock, upsert, params):
+    """Run lock, then upsert, in a savepoint; return upsert's one row.
+
+    upsert reports rows it found inserted by a concurrent transaction
+    (which lock couldn't see yet) in its last column, raced. Then the
+    savepoint is rolled back and both run again: by now that transaction
+    has committed, so lock finds the row and the upsert sees its score.
+    """
+
+    for _ in range(UPSERT_ATTEMPTS):
+        savepoint = db.session.begin_nested()
+        db.session.execute(lock, params)
+        row = db.session.execute(upsert, params).one()
+        if not row[-1]:
+            savepoint.commit()
+            return row
+        savepoint.rollback()
+
+    raise RuntimeError(f"Rating upsert kept racing after {UPSERT_ATTEMPTS} attempts")
+
+
+def upsert_rating(user_id, movie_id, score: int):
+    """Create or update one user's rating of a movie, by primary keys.
+
+    Returns (old_score, movie_title); old_score is None when the rating
+    is new. On PostgreSQL this is a row lock and a single INSERT ... ON
+    CONFLICT statement (which also updates the movie's rating summary)
+    and a single commit; concurrent upserts of the same rating queue on
+    the lock. Other databases get the same result from a few ORM
+    statements in one transaction.
+    """
+
+    if db.engine.dialect.name == "postgresql":
+        old_score, movie_title, _ = _execute_upsert(
+            _LOCK_RATING_SQL, _UPSERT_RATING_SQL,
+            {"user_id": user_id, "movie_id": movie_id, "score": score,
+             "trending_key": trending_key_at(datetime.now())})
+        invalidation.changed([movie_id])
+        db.session.commit()
+        invalidate_movie(movie_id)
+        return old_score, movie_title
+
+    rating = Rating.query.filter(
+        Rating.user_id == user_id, Rating.movie_id == movie_id).first()
+    if rating:
+        old_score = rating.score
+        rating.score = score
+    else:
+        old_score = None
+        db.session.add(Rating(user_id=user_id, movie_id=movie_id, score=score))
+
+    _apply_rating_delta(movie_id, old_score, score, user_id)
+    movie_title = db.session.query(Movie.title).filter(
+        Movie.movie_id == movie_id).scalar()
+    invalidation.changed([movie_id])
     db.session.commit()
-    return Rating(user = user_instance, movie = movie_instance, score = new_score)
+    invalidate_movie(movie_id)
+
+    return old_score, movie_title
+
+
+_IMPORT_SCORE_DELTA_SQL = ",\n        ".join(
+    f"SUM(CASE WHEN new_score = {score} THEN 1 ELSE 0 END"
+    f" - CASE WHEN old_score = {score} THEN 1 ELSE 0 END) AS score_{score}_delta"
+    for score in SCORES)
+
+_IMPORT_SCORE_SET_SQL = ",\n        ".join(
+    f"score_{score}_count = score_{score}_count + d.score_{score}_delta"
+    for score in SCORES)
+
+# Bulk version of _LOCK_RATING_SQL, locking in key order.
+_IMPORT_LOCK_RATINGS_SQL = text("""
+SELECT ratings.score
+FROM ratings JOIN unnest(CAST(:user_ids AS integer[]), CAST(:movie_ids AS integer[]))
+    AS incoming (user_id, movie_id) USING (user_id, movie_id)
+ORDER BY ratings.user_id, ratings.movie_id
+FOR UPDATE OF ratings
+""")
+
+# Bulk version of _UPSERT_RATING_SQL: one statement per chunk of rows,
+# passed as parallel arrays. Unchanged ratings are skipped by the ON
+# CONFLICT ... WHERE, and movie summaries are adjusted once per movie
+# from the aggregated deltas.
+_IMPORT_RATINGS_SQL = text(f"""
+WITH incoming (user_id, movie_id, score) AS (
+    SELECT * FROM unnest(CAST(:user_ids AS integer[]),
+                         CAST(:movie_ids AS integer[]),
+                         CAST(:scores AS integer[]))
+), previous AS (
+    SELECT ratings.user_id, ratings.movie_id, ratings.score AS old_score
+    FROM ratings JOIN incoming USING (user_id, movie_id)
+), upserted AS (
+    INSERT INTO ratings (user_id, movie_id, score)
+    SELECT user_id, movie_id, score FROM incoming
+    ON CONFLICT (user_id, movie_id) DO UPDATE SET score = EXCLUDED.score
+    WHERE ratings.score IS DISTINCT FROM EXCLUDED.score
+    RETURNING user_id, movie_id, score AS new_score, (xmax = 0) AS inserted
+), changes AS (
+    SELECT upserted.user_id, upserted.movie_id, previous.old_score, upserted.new_score,
+           upserted.inserted
+    FROM upserted LEFT JOIN previous USING (user_id, movie_id)
+), movie_deltas AS (
+    SELECT movie_id,
+        COUNT(*) AS changed,
+        COUNT(*) FILTER (WHERE old_score IS NULL) AS added,
+        SUM(new_score - COALESCE(old_score, 0)) AS sum_delta,
+        {_IMPORT_SCORE_DELTA_SQL}
+    FROM changes
+    GROUP BY movie_id
+), summary AS (
+    UPDATE movies SET
+        rating_count = rating_count + d.added,
+        rating_sum = rating_sum + d.sum_delta,
+        {_IMPORT_SCORE_SET_SQL},
+        trending_key = CASE
+            WHEN ABS(trending_key - (:trending_key + LN(d.changed))) > 30
+            THEN GREATEST(trending_key, :trending_key + LN(d.changed))
+            ELSE GREATEST(trending_key, :trending_key + LN(d.changed))
+                 + LN(1 + EXP(-ABS(trending_key - (:trending_key + LN(d.changed)))))
+        END,
+        version = nextval('resource_version_seq')
+    FROM movie_deltas d
+    WHERE movies.movie_id = d.movie_id
+), user_versions AS (
+    UPDATE users SET version = nextval('resource_version_seq')
+    WHERE user_id IN (SELECT user_id FROM changes)
+)
+SELECT COUNT(*) FILTER (WHERE old_score IS NULL),
+       COUNT(*) FILTER (WHERE old_score IS NOT NULL),
+       COUNT(*) FILTER (WHERE NOT inserted AND old_score IS NULL) > 0 AS raced
+FROM changes
+""")
+
+
+def import_ratings(rows):
+    """Create or update a chunk of ratings in bulk, in one transaction.
+
+    rows is a list of ImportedRatings. Users and movies are looked up with
+    one IN query each; a later row for the same user and movie wins over
+    an earlier one. On PostgreSQL the existing ratings are locked, then
+    the whole chunk is written (and the movie summaries adjusted) by a
+    single statement; other databases do it row by row through the ORM.
+
+    Returns (counts, errors): counts is a dict of how many ratings were
+    created, updated or unchanged, errors a list of (line, message) for
+    rows naming users or movies that don't exist.
+    """
+
+    emails = {row.email for row in rows if row.user_id is None}
+    user_ids_by_email = dict(db.session.query(User.email, User.user_id).filter(
+        User.email.in_(emails))) if emails else {}
+
+    wanted_user_ids = {row.user_id for row in rows if row.user_id is not None}
+    known_user_ids = {user_id for (user_id,) in db.session.query(User.user_id).filter(
+        User.user_id.in_(wanted_user_ids))} if wanted_user_ids else set()
+
+    known_movie_ids = {movie_id for (movie_id,) in db.session.query(Movie.movie_id).filter(
+        Movie.movie_id.in_({row.movie_id for row in rows}))}
+
+    scores = {}
+    errors = []
+    for row in rows:
+        if row.user_id is None:
+            user_id = user_ids_by_email.get(row.email)
+        else:
+            user_id = row.user_id if row.user_id in known_user_ids else None
+
+        if user_id is None:
+            errors.append((row.line, f"Unknown user: {row.email or row.user_id}"))
+        elif row.movie_id not in known_movie_ids:
+            errors.append((row.line, f"Unknown movie_id: {row.movie_id}"))
+        else:
+            scores[(user_id, row.movie_id)] = row.score
+
+    counts = {"created": 0, "updated": 0, "unchanged": 0}
+    if not scores:
+        return counts, errors
+
+    if db.engine.dialect.name == "postgresql":
+        keys = sorted(scores)  # the same lock order in every import
+        counts["created"], counts["updated"], _ = _execute_upsert(
+            _IMPORT_LOCK_RATINGS_SQL, _IMPORT_RATINGS_SQL,
+            {"user_ids": [user_id for user_id, _ in keys],
+             "movie_ids": [movie_id for _, movie_id in keys],
+             "scores": [scores[key] for key in keys],
+             "trending_key": trending_key_at(datetime.now())})
+    else:
+        user_ids = {user_id for user_id, _ in scores}
+        existing = {(rating.user_id, rating.movie_id): rating
+                    for rating in Rating.query.filter(
+                        Rating.user_id.in_(user_ids),
+                        Rating.movie_id.in_({movie_id for _, movie_id in scores}))}
+        for (user_id, movie_id), score in scores.items():
+            rating = existing.get((user_id, movie_id))
+            if rating is None:
+                db.session.add(Rating(user_id=user_id, movie_id=movie_id, score=score))
+                _apply_rating_delta(movie_id, None, score, user_id)
+                counts["created"] += 1
+            elif rating.score != score:
+                _apply_rating_delta(movie_id, rating.score, score, user_id)
+                rating.score = score
+                counts["updated"] += 1
+
+    movie_ids = {movie_id for _, movie_id in scores}
+    invalidation.changed(movie_ids)
+    db.session.commit()
+    counts["unchanged"] = len(scores) - counts["created"] - counts["updated"]
+
+    evict_movies(movie_ids)
+
+    return counts, errors
+
+
+@replica_read
+def get_ratings_by_keys(keys):
+    """Return {(user_id, movie_id): rating} for many (user_id, movie_id) keys.
+
+    One query, on the (user_id, movie_id) unique index.
+    """
+
+    keys = set(keys)
+    ratings = Rating.query.filter(Rating.user_id.in_({user_id for user_id, _ in keys}),
+                                  Rating.movie_id.in_({movie_id for _, movie_id in keys}))
+
+    return {(rating.user_id, rating.movie_id): rating for rating in ratings
+            if (rating.user_id, rating.movie_id) in keys}
+
+
+def get_rating_score(user_id, movie_id):
+    """Return a user's score for a movie, or None if they haven't rated it."""
+
+    return db.session.query(Rating.score).filter(
+        Rating.user_id == user_id, Rating.movie_id == movie_id).scalar()
+
 
 def get_score_for_existing_rating(user_instance, movie_instance):
     score = Rating.query.filter(Rating.movie == movie_instance, Rating.user == user_instance).first().score
@@ -248,5 +1172,5 @@ def does_this_rating_exist_already(user_instance, movie_instance):
 
 if __name__ == '__main__':
     """Will connect you to the database when you run crud.py interactively"""
-    from server import app
-    connect_to_db(app)
+    from server import create_app
+    app = create_app()
@@ -0,0 +1,210 @@
+"""Streaming exports of the ratings, movies and users tables.
+
+Rows are read in key order from a server-side cursor (stream_results)
+FETCH_SIZE at a time and written out as they arrive, so memory stays flat
+however big the table is. Each format is a generator of byte chunks:
+
+    for chunk in export.export_table("ratings", "csv", gzip=True):
+        out.write(chunk)
+
+Exports are ordered by the table's key column (the first column), so an
+interrupted export resumes from the last key it wrote:
+
+    export.export_table("ratings", "csv", after=123456)
+
+A resumed CSV export has no header row, so it can be appended to what
+was already written.
+
+Parquet needs pyarrow, which is optional (pip install pyarrow).
+
+Served at GET /export/<table> (see server.py) and run from the command
+line by export_data.py.
+"""
+
+import csv
+import io
+import json
+import zlib
+
+from model import db, Movie, Rating, SCORES, User, reading_from_replica
+
+pyarrow = None  # imported by the first Parquet export; it's slow to import
+
+FETCH_SIZE = 10000  # rows per round trip, and per Parquet row group
+
+# Exported columns, key column first. (Never password hashes.)
+TABLES = {
+    "ratings": (Rating.rating_id, Rating.user_id, Rating.movie_id, Rating.score),
+    "movies": (Movie.movie_id, Movie.title, Movie.overview, Movie.release_date,
+               Movie.poster_path, Movie.rating_count, Movie.rating_sum,
+               *[Movie.score_column(score) for score in SCORES]),
+    "users": (User.user_id, User.email),
+}
+
+FORMATS = {  # format: mimetype
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def iter_batches(table, after=None, fetch_size=FETCH_SIZE):
+    """Yield lists of up to fetch_size rows of table, in key order.
+
+    Reads from a replica when there is one. Must run inside an app
+    context, for as long as the batches are being consumed.
+    """
+
+    columns = TABLES[table]
+    key = columns[0]
+
+    query = db.select(*columns).order_by(key)
+    if after is not None:
+        query = query.where(key > after)
+
+    with reading_from_replica():
+        result = db.session.execute(query.execution_options(
+            stream_results=True, yield_per=fetch_size))
+        yield from result.partitions(fetch_size)
+
+
+def column_names(table):
+    return [column.key for column in TABLES[table]]
+
+
+def _csv_chunks(table, batches, header=True):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    if header:
+        writer.writerow(column_names(table))
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _ndjson_chunks(table, batches):
+    names = column_names(table)
+
+    for rows in batches:
+        yield "".join(json.dumps(dict(zip(names, row)), default=str) + "\n"
+                      for row in rows).encode()
+
+
+class _ChunkSink:
+    """A write-only file that hands what was written to it back in chunks.
+
+    Keeps its own position, since the Parquet writer uses tell() to
+    record where each row group starts.
+    """
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow_type(column_type):
+    if isinstance(column_type, db.DateTime):
+        return pyarrow.timestamp("us")
+    if isinstance(column_type, db.Float):
+        return pyarrow.float64()
+    if isinstance(column_type, db.Integer):
+        return pyarrow.int64()
+    return pyarrow.string()
+
+
+def _parquet_chunks(table, batches):
+    schema = pyarrow.schema([(column.key, _arrow_type(column.type))
+                             for column in TABLES[table]])
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+
+    for rows in batches:
+        writer.write_table(pyarrow.Table.from_pylist(
+            [dict(row._mapping) for row in rows], schema=schema))
+        yield sink.drain()
+
+    writer.close()
+    yield sink.drain()
+
+
+def _import_pyarrow():
+    """Import pyarrow into this module; return False if it isn't installed."""
+
+    global pyarrow
+
+    if pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:  # Parquet exports are optional.
+            return False
+
+    return True
+
+
+_WRITERS = {"csv": _csv_chunks, "ndjson": _ndjson_chunks, "parquet": _parquet_chunks}
+
+
+def _gzipped(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # gzip framing
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
+
+
+def export_table(table, format="csv", after=None, gzip=False, fetch_size=FETCH_SIZE):
+    """Return a generator of the bytes of table exported in format.
+
+    Raises ValueError for an unknown table or format, and RuntimeError for
+    Parquet without pyarrow (before anything is read).
+    """
+
+    if table not in TABLES:
+        raise ValueError(f"Unknown table: {table!r}")
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format: {format!r}")
+    if format == "parquet" and not _import_pyarrow():
+        raise RuntimeError("Parquet exports need pyarrow (pip install pyarrow)")
+
+    batches = iter_batches(table, after, fetch_size)
+    if format == "csv":
+        chunks = _csv_chunks(table, batches, header=after is None)
+    else:
+        chunks = _WRITERS[format](table, batches)
+
+    return _gzipped(chunks) if gzip else chunks
+
+
+def filename(table, format, gzip=False):
+    return f"{table}.{format}" + (".gz" if gzip else "")
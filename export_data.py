@@ -0,0 +1,45 @@
+"""Script to export the ratings, movies or users table.
+
+    $ python3 export_data.py ratings > ratings.csv
+    $ python3 export_data.py movies --format ndjson --gzip -o movies.ndjson.gz
+    $ python3 export_data.py ratings --format parquet -o ratings.parquet
+    $ python3 export_data.py ratings --after 123456 >> ratings.csv  # resume
+
+Rows stream from a server-side cursor in key order; see export.py.
+"""
+
+import argparse
+import sys
+
+import export
+import server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("table", choices=sorted(export.TABLES))
+    parser.add_argument("--format", choices=sorted(export.FORMATS), default="csv")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--after", type=int,
+                        help="resume after this key (the first column)")
+    parser.add_argument("-o", "--output", help="file to write (default: stdout)")
+    parser.add_argument("--db-uri", default="postgresql:///ratings")
+    args = parser.parse_args(argv)
+
+    app = server.create_app({"DATABASE_URI": args.db_uri})
+
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        with app.app_context():
+            for chunk in export.export_table(args.table, args.format,
+                                             after=args.after, gzip=args.gzip):
+                out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""Conditional GETs and fragment caching for rendered pages.
+
+Pages are keyed on the versions crud keeps for the catalog, each movie and
+each user (see model.next_version). A view builds its ETag from the
+versions it depends on before doing any real work:
+
+    etag = http_cache.make_etag("movie", crud.get_movie_version(movie_id), ...)
+    response = http_cache.not_modified(etag)
+    if response:
+        return response
+    ...
+    return http_cache.with_etag(render_template(...), etag)
+
+so a repeat view costs a version lookup and an empty 304.
+
+Pages that do get rendered can reuse fragments: cached_fragment() renders a
+template macro once per key (which should include the version of whatever
+the fragment shows) and serves later calls from fragment_cache.
+"""
+
+import hashlib
+
+from flask import get_template_attribute, make_response, request, session
+from markupsafe import Markup
+
+import cache
+
+fragment_cache = cache.Cache(cache.LRUBackend(maxsize=50000, ttl=3600))
+
+
+def make_etag(*parts):
+    """Return a strong ETag for a page built from parts (versions, args...)."""
+
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def not_modified(etag):
+    """Return a 304 response if the client already has etag, else None.
+
+    Pending flash messages would be lost with a 304, so pages with some
+    are always rendered.
+    """
+
+    if session.get("_flashes") or not request.if_none_match.contains_weak(etag):
+        return None
+
+    return with_etag(make_response("", 304), etag)
+
+
+def with_etag(response, etag):
+    """Mark a page response as revalidate-every-time with etag."""
+
+    response = make_response(response)
+    response.set_etag(etag)
+    # Pages depend on who is logged in, so only the browser may keep them.
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+
+    return response
+
+
+def cached_fragment(template_name, macro_name, key, *args):
+    """Render macro_name from template_name with args, cached under key.
+
+    Available in templates, e.g.
+        {{ cached_fragment('_fragments.html', 'movie_item',
+                           (movie.movie_id, movie.version), movie) }}
+    """
+
+    html = fragment_cache.get_or_load(
+        (template_name, macro_name) + tuple(key),
+        lambda: str(get_template_attribute(template_name, macro_name)(*args)))
+
+    return Markup(html)
+
+
+def init_app(app):
+    """Make cached_fragment available to app's templates."""
+
+    app.jinja_env.globals["cached_fragment"] = cached_fragment
@@ -0,0 +1,45 @@
+"""Script to import ratings in bulk from an NDJSON or CSV file.
+
+    $ python3 import_ratings.py partner-ratings.ndjson
+    $ python3 import_ratings.py partner-ratings.csv
+    $ zcat ratings.csv.gz | python3 import_ratings.py - --format csv
+
+See rating_import.py for the record format. Prints the import report and
+exits 1 if any record failed.
+"""
+
+import argparse
+import json
+import sys
+
+import rating_import
+import server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="file to import, or - for stdin")
+    parser.add_argument("--format", choices=rating_import.FORMATS,
+                        help="default: csv for .csv files, otherwise ndjson")
+    parser.add_argument("--chunk-size", type=int, default=rating_import.CHUNK_SIZE)
+    parser.add_argument("--db-uri", default="postgresql:///ratings")
+    args = parser.parse_args(argv)
+
+    format = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+
+    app = server.create_app({"DATABASE_URI": args.db_uri})
+
+    with app.app_context():
+        if args.path == "-":
+            report = rating_import.import_lines(sys.stdin, format, args.chunk_size)
+        else:
+            with open(args.path, newline="") as f:
+                report = rating_import.import_lines(f, format, args.chunk_size)
+
+    print(json.dumps(report, indent=2))
+
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""Per-request SQL and render instrumentation.
+
+init_app(app) hooks SQLAlchemy's before/after_cursor_execute events and
+Flask's request hooks to record, for every route:
+
+- how many queries ran and how long they took in total,
+- how long template rendering took,
+- how long the whole request took,
+- requests that ran the same statement REPEAT_THRESHOLD or more times
+  (the classic N+1 loop), which are also logged as warnings.
+
+The totals are served in Prometheus text format at /_metrics. Set
+app.config["SERVER_TIMING"] = True to also send a Server-Timing header
+with each response, which browser dev tools show per request.
+"""
+
+import threading
+import time
+from collections import Counter, defaultdict
+
+import jinja2
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REPEAT_THRESHOLD = 5
+
+ROUTE_METRICS = (
+    ("requests", "Requests handled."),
+    ("queries", "SQL statements executed."),
+    ("db_seconds", "Time spent executing SQL."),
+    ("render_seconds", "Time spent rendering templates."),
+    ("request_seconds", "Time spent handling requests."),
+    ("repeated_statement_requests",
+     f"Requests that ran one statement {REPEAT_THRESHOLD}+ times (likely N+1)."),
+)
+
+_route_totals = defaultdict(Counter)
+_lock = threading.Lock()
+_collectors = {}  # name: collector
+
+
+def _in_request():
+    return has_request_context() and "_metrics_started" in g
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _in_request():
+        g._metrics_query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _in_request() and "_metrics_query_started" in g:
+        g._metrics_db_seconds += time.perf_counter() - g._metrics_query_started
+        g._metrics_statements[statement] += 1
+
+
+class TimedTemplate(jinja2.Template):
+    """A Template that adds its render time to the current request's."""
+
+    def render(self, *args, **kwargs):
+        if not _in_request():
+            return super().render(*args, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            g._metrics_render_seconds += time.perf_counter() - started
+
+
+def _start_request():
+    g._metrics_started = time.perf_counter()
+    g._metrics_db_seconds = 0.0
+    g._metrics_render_seconds = 0.0
+    g._metrics_statements = Counter()
+
+
+def _finish_request(response):
+    if "_metrics_started" not in g:
+        return response
+
+    request_seconds = time.perf_counter() - g._metrics_started
+    statements = g._metrics_statements
+    query_count = sum(statements.values())
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+
+    repeated = [(statement, count) for statement, count in statements.items()
+                if count >= REPEAT_THRESHOLD]
+    for statement, count in repeated:
+        current_app.logger.warning(
+            "%s ran the same statement %d times (N+1?): %s",
+            route, count, " ".join(statement.split())[:200])
+
+    with _lock:
+        totals = _route_totals[route]
+        totals["requests"] += 1
+        totals["queries"] += query_count
+        totals["db_seconds"] += g._metrics_db_seconds
+        totals["render_seconds"] += g._metrics_render_seconds
+        totals["request_seconds"] += request_seconds
+        totals["repeated_statement_requests"] += bool(repeated)
+
+    if current_app.config.get("SERVER_TIMING"):
+        response.headers["Server-Timing"] = (
+            f'db;dur={g._metrics_db_seconds * 1000:.1f};desc="{query_count} queries", '
+            f"render;dur={g._metrics_render_seconds * 1000:.1f}, "
+            f"total;dur={request_seconds * 1000:.1f}")
+
+    return response
+
+
+def register_collector(name, collector):
+    """Add a callable returning extra (name, help, type, samples) metrics.
+
+    samples is a list of (labels_dict, value) pairs. Collectors run on every
+    scrape of /_metrics. Registering under a name again replaces the
+    collector, so building another app (or restarting a thread) doesn't
+    export the same metrics twice.
+    """
+
+    _collectors[name] = collector
+
+
+def _format_metric(name, help_text, metric_type, samples):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        label_text = ",".join(f'{key}="{label}"' for key, label in sorted(labels.items()))
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return lines
+
+
+def render_metrics():
+    """Return every metric in Prometheus text exposition format."""
+
+    with _lock:
+        snapshot = {route: dict(totals) for route, totals in _route_totals.items()}
+
+    lines = []
+    for key, help_text in ROUTE_METRICS:
+        samples = [({"route": route}, totals.get(key, 0))
+                   for route, totals in sorted(snapshot.items())]
+        lines += _format_metric(f"ratings_{key}_total", help_text, "counter", samples)
+
+    for collector in list(_collectors.values()):
+        for metric in collector():
+            lines += _format_metric(*metric)
+
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    """Instrument app's requests and serve the results at /_metrics."""
+
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule("/_metrics", "metrics", metrics_view)
@@ -0,0 +1,175 @@
+"""Cross-process cache invalidation with PostgreSQL LISTEN/NOTIFY.
+
+crud.movie_cache is per process by default, so a rating written by one
+worker would leave every other worker serving the old average until the
+entry expired. Instead:
+
+- write paths call changed(movie_ids) inside their transaction. What
+  changed is collected on the session and published with one pg_notify()
+  right before the commit, so the event is delivered if and only if the
+  write commits, and a bulk write sends one event, not one per row;
+- every process runs a listener thread (start_listener) holding its own
+  connection with LISTEN. Whatever notifications have arrived are
+  drained and applied together with one call to evict;
+- a listener that loses its connection may have missed events, so every
+  (re)connect calls resync, which drops the whole local cache.
+
+Events are compact JSON, {"movies": [1, 2, 3]}, or {"all": true} when
+more than MAX_IDS_PER_EVENT movies changed (or everything did). Only
+PostgreSQL has NOTIFY; elsewhere changed() is a no-op.
+"""
+
+import json
+import select
+import threading
+
+from sqlalchemy import event, text
+
+import instrumentation
+from model import RoutingSession, db
+
+CHANNEL = "ratings_cache_invalidation"
+MAX_IDS_PER_EVENT = 1000  # keeps payloads well under NOTIFY's 8000 bytes
+POLL_SECONDS = 5
+RECONNECT_SECONDS = 1
+
+_SESSION_KEY = "changed_movies"
+_EVERYTHING = "all"
+
+
+def changed(movie_ids=(), everything=False):
+    """Record, in the current transaction, that these movies changed.
+
+    With no movie_ids, only catalog-wide data (listings, rankings) is
+    stale; everything=True means drop every cached movie.
+    """
+
+    pending = db.session.info.setdefault(_SESSION_KEY, set())
+    if everything:
+        pending.add(_EVERYTHING)
+    pending.update(movie_ids)
+
+
+def _payloads(pending):
+    movie_ids = sorted(movie_id for movie_id in pending if movie_id != _EVERYTHING)
+
+    if _EVERYTHING in pending or len(movie_ids) > MAX_IDS_PER_EVENT:
+        return [json.dumps({"all": True})]
+
+    return [json.dumps({"movies": movie_ids}, separators=(",", ":"))]
+
+
+@event.listens_for(RoutingSession, "before_commit")
+def _publish(session):
+    pending = session.info.pop(_SESSION_KEY, None)
+    if pending is None or db.engine.dialect.name != "postgresql":
+        return
+
+    for payload in _payloads(pending):
+        session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                        {"channel": CHANNEL, "payload": payload})
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _forget(session):
+    session.info.pop(_SESSION_KEY, None)
+
+
+def parse(payloads):
+    """Merge event payloads into (movie_ids, everything)."""
+
+    movie_ids = set()
+    for payload in payloads:
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return set(), True  # can't tell what changed, so assume everything
+        if message.get("all"):
+            return set(), True
+        movie_ids.update(message.get("movies", ()))
+
+    return movie_ids, False
+
+
+class Listener:
+    """A thread applying invalidation events to this process's caches."""
+
+    def __init__(self, app, evict, resync):
+        """evict(movie_ids, everything) applies a batch of events;
+        resync() runs after every (re)connect."""
+
+        self.app = app
+        self.evict = evict
+        self.resync = resync
+        self.events = 0
+        self.reconnects = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="cache-invalidation",
+                                        daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _connect(self):
+        # A connection of its own, outside the pool: it is held forever.
+        engine = db.get_engine(self.app)
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        connection = engine.dialect.dbapi.connect(*cargs, **cparams)
+        connection.autocommit = True
+        connection.cursor().execute(f"LISTEN {CHANNEL}")
+        return connection
+
+    def _run(self):
+        while not self._stopping.is_set():
+            connection = None
+            try:
+                connection = self._connect()
+                self.resync()
+                self._listen(connection)
+            except Exception:
+                self.app.logger.exception("Cache invalidation listener lost its connection")
+                self.reconnects += 1
+                self._stopping.wait(RECONNECT_SECONDS)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def _listen(self, connection):
+        while not self._stopping.is_set():
+            if select.select([connection], [], [], POLL_SECONDS) == ([], [], []):
+                # Quiet: make sure that's not because the connection died.
+                connection.cursor().execute("SELECT 1")
+                continue
+
+            connection.poll()
+            payloads = [notify.payload for notify in connection.notifies]
+            connection.notifies.clear()
+            if payloads:
+                self.events += len(payloads)
+                self.evict(*parse(payloads))
+
+    def metrics(self):
+        """Return metrics for instrumentation.register_collector."""
+
+        return [("ratings_cache_invalidation_events_total",
+                 "Invalidation events received.", "counter", [({}, self.events)]),
+                ("ratings_cache_invalidation_reconnects_total",
+                 "Times the invalidation listener reconnected.", "counter",
+                 [({}, self.reconnects)])]
+
+
+def start_listener(app, evict, resync):
+    """Start a Listener for app if it runs on PostgreSQL; return it (or None)."""
+
+    if db.get_engine(app).dialect.name != "postgresql":
+        return None
+
+    listener = Listener(app, evict, resync).start()
+    instrumentation.register_collector("cache_invalidation", listener.metrics)
+
+    return listener
@@ -0,0 +1,110 @@
+"""Request-scoped, batching loaders for users, movies and ratings.
+
+A view used to look rows up one at a time, sometimes the same row twice
+(get_user_by_email, then does_this_rating_exist_already and
+get_score_for_existing_rating running the same filter). Instead, each
+request gets a RequestLoaders on flask.g, in the style of DataLoader:
+
+    loaders = get_loaders()
+    loaders.movies.defer(*similar_ids)       # fetched with the next load
+    movie = loaders.movies.load(movie_id)    # one IN query for all of them
+    loaders.movies.load_many(similar_ids)    # no query: already loaded
+
+Every key is fetched at most once per request, and keys asked for together
+(or deferred) are fetched in a single IN query. Missing rows load as None.
+"""
+
+from flask import g, session
+
+import crud
+
+
+class Loader:
+    """Batches and memoizes lookups of one kind of row, by key."""
+
+    def __init__(self, batch_load):
+        """batch_load(keys) returns {key: row} for the keys that exist."""
+
+        self.batch_load = batch_load
+        self.batches = 0
+        self._results = {}
+        self._deferred = []
+
+    def defer(self, *keys):
+        """Queue keys to be fetched along with the next load."""
+
+        self._deferred.extend(key for key in keys if key not in self._results)
+
+    def load_many(self, keys):
+        """Return {key: row or None} for keys, fetching the new ones at once."""
+
+        keys = list(keys)
+        missing = list(dict.fromkeys(key for key in self._deferred + keys
+                                     if key not in self._results))
+        self._deferred = []
+
+        if missing:
+            found = self.batch_load(missing)
+            self.batches += 1
+            for key in missing:
+                self._results[key] = found.get(key)
+
+        return {key: self._results[key] for key in keys}
+
+    def load(self, key):
+        return self.load_many([key])[key]
+
+    def prime(self, key, row):
+        """Remember a row loaded some other way."""
+
+        self._results[key] = row
+
+
+class RequestLoaders:
+    """The loaders for one request."""
+
+    def __init__(self):
+        self.users = Loader(crud.get_users_by_ids)
+        self.users_by_email = Loader(self._load_users_by_email)
+        self.movies = Loader(crud.get_movies_by_ids)
+        self.ratings = Loader(crud.get_ratings_by_keys)  # by (user_id, movie_id)
+
+    def _load_users_by_email(self, emails):
+        users = crud.get_users_by_emails(emails)
+        for user in users.values():
+            self.users.prime(user.user_id, user)
+        return users
+
+    def current_user_id(self):
+        """Return the logged-in user's id, or None.
+
+        Read from the session; a session from before user_id was stored
+        there gets it looked up by email once and saved.
+        """
+
+        if "user_id" not in session and "user_email" in session:
+            user = self.users_by_email.load(session["user_email"])
+            if user is not None:
+                session["user_id"] = user.user_id
+
+        return session.get("user_id")
+
+
+def _start_request():
+    # A fresh set per request, even when g (the app context) outlives one.
+    g.loaders = RequestLoaders()
+
+
+def get_loaders():
+    """Return this request's RequestLoaders."""
+
+    if "loaders" not in g:
+        g.loaders = RequestLoaders()
+
+    return g.loaders
+
+
+def init_app(app):
+    """Give every request of app its own loaders."""
+
+    app.before_request(_start_request)
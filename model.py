@@ -1,9 +1,178 @@
 """Models for movie ratings app."""
 
-from flask_sqlalchemy import SQLAlchemy
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import has_request_context, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from datetime import datetime
+from sqlalchemy import DDL, event, literal_column, orm
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.elements import TextClause
+
+# Seconds after a user's own write during which their reads skip the
+# replicas, so they always see what they just did (replication lag).
+READ_YOUR_WRITES_SECONDS = 5
+
+_replica_reads = ContextVar("replica_reads", default=False)
+
+
+class RoutingSession(SignallingSession):
+    """A session that sends replica_read() queries to a read replica.
+
+    Everything else -- flushes, INSERT/UPDATE/DELETE, raw SQL text, and
+    any read inside a session that has already written -- goes to the
+    primary. Commits that wrote something record the time in the Flask
+    session, which keeps that user on the primary for a little while.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica_keys = self.app.config.get("REPLICA_BIND_KEYS")
+
+        writing = (self._flushing or isinstance(clause, TextClause)
+                   or getattr(clause, "is_dml", False))
+        if writing:
+            self.info["wrote"] = True
+
+        if (replica_keys and _replica_reads.get() and not writing
+                and not self.info.get("wrote") and not _recently_wrote(self.app)):
+            return db.get_engine(self.app, bind=random.choice(replica_keys))
+
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def _recently_wrote(app):
+    if not has_request_context():
+        return False
+
+    window = app.config.get("READ_YOUR_WRITES_SECONDS", READ_YOUR_WRITES_SECONDS)
+    return time.time() - flask_session.get("last_write_at", 0) < window
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _remember_write(session):
+    if session.info.pop("wrote", False) and has_request_context():
+        flask_session["last_write_at"] = time.time()
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _forget_write(session):
+    session.info.pop("wrote", None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with RoutingSession as its session class.
+
+    Each engine -- the primary and every replica bind -- gets the
+    engine_options() for its own URI, so a SQLite replica next to a
+    PostgreSQL primary (or the other way round) gets the right pool.
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        options.update(engine_options(sa_url, engine_settings(app.config)))
+
+        return sa_url, options
+
+
+def replica_read(function):
+    """Decorate a read-only crud function to run it against a replica."""
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with reading_from_replica():
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def reading_from_replica():
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+@contextmanager
+def reading_from_primary():
+    """Send reads to the primary, even inside a replica_read function."""
+
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+db = RoutingSQLAlchemy()
+
+
+@event.listens_for(Engine, "connect")
+def _add_sqlite_math(dbapi_connection, connection_record):
+    """Give SQLite the math functions the trending update uses."""
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function("greatest", 2, max, deterministic=True)
+        dbapi_connection.create_function("ln", 1, math.log, deterministic=True)
+        dbapi_connection.create_function("exp", 1, math.exp, deterministic=True)
+
+SCORES = range(6)  # Ratings are scored from 0-5.
+
+# /movies/top ranks by a damped ("Bayesian") average: every movie starts
+# with PRIOR_WEIGHT phantom ratings of PRIOR_MEAN, so a single 5 can't
+# outrank a film hundreds of people rated 4.5.
+PRIOR_MEAN = 2.5
+PRIOR_WEIGHT = 10
+
+# /movies/trending ranks by ratings with exponential time decay. Each
+# rating adds e^(ln2 * age_since_epoch / half_life) to a movie's score;
+# since every movie decays at the same rate the order never changes
+# without new ratings, so the score can live in an index. It is stored
+# as a log (trending_key) to stay finite.
+TRENDING_HALF_LIFE = 24 * 60 * 60  # seconds
+TRENDING_EPOCH = datetime(2022, 1, 1)
+
+
+def trending_key_at(when):
+    """Return the log-score one rating made at `when` is worth."""
+
+    seconds = (when - TRENDING_EPOCH).total_seconds()
+    return math.log(2) * seconds / TRENDING_HALF_LIFE
 
-db = SQLAlchemy()
+
+# Versions of movies and users, for ETags and fragment caching. Each write
+# takes a fresh number from one sequence, so "the catalog changed" is just
+# a change in MAX(movies.version). Rows loaded in bulk start at 0.
+version_sequence = db.Sequence("resource_version_seq", metadata=db.Model.metadata)
+
+
+def next_version(dialect_name):
+    """Return a SQL expression for a new version number."""
+
+    if dialect_name == "postgresql":
+        return version_sequence.next_value()
+
+    # No sequences (SQLite): nanoseconds are unique enough on one machine.
+    return literal_column(str(time.time_ns()))
+
+
+def _default_version(context):
+    return context.connection.scalar(
+        db.select(next_version(context.dialect.name)))
 
 
 class User(db.Model):
@@ -15,7 +184,10 @@ class User(db.Model):
                         autoincrement=True,
                         primary_key=True)
     email = db.Column(db.String(256), unique=True, nullable=False)
-    password = db.Column(db.String, nullable = False)
+    password_hash = db.Column(db.String, nullable = False)  # see passwords.py
+    # Bumped whenever the user's ratings change:
+    version = db.Column(db.BigInteger, nullable=False, default=_default_version,
+                        server_default="0")
     # ratings = a list of Rating objects
 
     def __repr__(self):
@@ -35,14 +207,87 @@ class Movie(db.Model):
     poster_path = db.Column(db.String, nullable=True)
     # ratings = a list of Rating objects
 
+    # Rating summary, kept up to date by crud.create_rating/update_rating
+    # so pages never have to aggregate the ratings table:
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    score_0_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    score_1_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    score_2_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    score_3_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    score_4_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    score_5_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    trending_key = db.Column(db.Float, nullable=False, default=0.0, server_default="0",
+                             index=True)
+    # Bumped whenever the movie or its rating summary changes:
+    version = db.Column(db.BigInteger, nullable=False, default=_default_version,
+                        server_default="0", index=True)
+
+    @hybrid_property
+    def bayesian_score(self):
+        """The damped average /movies/top ranks by (see PRIOR_MEAN)."""
+        return ((PRIOR_WEIGHT * PRIOR_MEAN + (self.rating_sum or 0))
+                / (PRIOR_WEIGHT + (self.rating_count or 0)))
+
+    @bayesian_score.expression
+    def bayesian_score(cls):
+        # Literal columns (not bound parameters) so the same expression can
+        # be indexed, and so float division happens in SQL.
+        return ((literal_column(repr(float(PRIOR_WEIGHT * PRIOR_MEAN))) + cls.rating_sum)
+                / (literal_column(repr(float(PRIOR_WEIGHT))) + cls.rating_count))
+
+    def recent_ratings(self, now=None):
+        """Decayed count of recent ratings, from trending_key."""
+        return math.exp((self.trending_key or 0.0) - trending_key_at(now or datetime.now()))
+
+    @staticmethod
+    def score_column(score):
+        """Return the histogram column counting ratings of this score."""
+        return getattr(Movie, f"score_{score}_count")
+
+    @property
+    def average_rating(self):
+        """The average score, rounded for display (0.0 when unrated)."""
+        if not self.rating_count:
+            return 0.0
+        return round(float(self.rating_sum) / self.rating_count, 1)
+
+    @property
+    def score_histogram(self):
+        """Counts of ratings per score, indexed by score 0-5."""
+        return [getattr(self, f"score_{score}_count") or 0 for score in SCORES]
+
     def __repr__(self):
         return f'movie_id: {self.movie_id}\ntitle: {self.title}\noverview: {self.overview}\
             \nrelease_date: {self.release_date}\nposter path: {self.poster_path}\n'
 
+# Keeps /movies/top an index scan; PostgreSQL maintains it on every
+# rating summary update.
+db.Index("ix_movies_bayesian_score", Movie.bayesian_score.desc(), Movie.movie_id)
+
+# Movie search (crud.search_movies) on PostgreSQL: a generated tsvector of
+# title and overview with a GIN index, and a trigram index on titles for
+# typos. It is not mapped on Movie, since other databases don't have it;
+# they use search.SearchIndex instead.
+event.listen(db.Model.metadata, "before_create", DDL(
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+event.listen(Movie.__table__, "after_create", DDL("""
+ALTER TABLE movies ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+    setweight(to_tsvector('english', coalesce(title, '')), 'A')
+    || setweight(to_tsvector('english', coalesce(overview, '')), 'B')) STORED;
+CREATE INDEX ix_movies_search_vector ON movies USING gin (search_vector);
+CREATE INDEX ix_movies_title_trgm ON movies USING gin (title gin_trgm_ops);
+""").execute_if(dialect="postgresql"))
+
+
 class Rating(db.Model):
     """A rating."""
 
     __tablename__ = 'ratings'
+    # One rating per user per movie; crud.upsert_rating relies on this.
+    # The second index serves a user's ratings in rating_id pages.
+    __table_args__ = (db.UniqueConstraint("user_id", "movie_id"),
+                      db.Index("ix_ratings_user_id_rating_id", "user_id", "rating_id"))
 
     rating_id = db.Column(db.Integer,
                         autoincrement=True,
@@ -80,7 +325,135 @@ How will you associate a rating with a certain user and movie?
     Maybe a ratings table and a movies table and a users table. JOIN
 """
 
-def connect_to_db(flask_app, db_uri="postgresql:///ratings", echo=True):
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that records how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+
+# Engine settings, read from app.config first and then the environment:
+#   name: (default, type)
+ENGINE_SETTINGS = {
+    "DB_POOL_SIZE": (10, int),
+    "DB_MAX_OVERFLOW": (10, int),
+    "DB_POOL_TIMEOUT": (30, float),  # seconds to wait for a free connection
+    "DB_POOL_RECYCLE": (1800, int),  # seconds before a connection is replaced
+    "DB_POOL_PRE_PING": (True, lambda value: str(value).lower() in ("1", "true", "yes")),
+    "DB_STATEMENT_TIMEOUT": (None, int),  # milliseconds, enforced by PostgreSQL
+    "DB_APPLICATION_NAME": ("ratings", str),  # shows up in pg_stat_activity
+}
+
+
+def engine_settings(config):
+    """Return ENGINE_SETTINGS resolved from config and the environment."""
+
+    settings = {}
+    for name, (default, cast) in ENGINE_SETTINGS.items():
+        value = config.get(name, os.environ.get(name))
+        settings[name] = default if value in (None, "") else cast(value)
+
+    return settings
+
+
+def engine_options(db_uri, settings):
+    """Translate engine_settings() into create_engine() options for db_uri."""
+
+    if make_url(db_uri).get_backend_name() != "postgresql":
+        return {}  # SQLite and friends use their own pools
+
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": settings["DB_POOL_SIZE"],
+        "max_overflow": settings["DB_MAX_OVERFLOW"],
+        "pool_timeout": settings["DB_POOL_TIMEOUT"],
+        "pool_recycle": settings["DB_POOL_RECYCLE"],
+        "pool_pre_ping": settings["DB_POOL_PRE_PING"],
+        "connect_args": {"application_name": settings["DB_APPLICATION_NAME"]},
+    }
+    if settings["DB_STATEMENT_TIMEOUT"]:
+        options["connect_args"]["options"] = (
+            f"-c statement_timeout={settings['DB_STATEMENT_TIMEOUT']}")
+
+    return options
+
+
+def pool_metrics():
+    """Pool gauges and counters for instrumentation.register_collector.
+
+    Every pool is exported, labelled bind="primary" or with its replica's
+    bind key.
+    """
+
+    app = db.get_app()
+    engines = [("primary", db.get_engine(app))] + [
+        (key, db.get_engine(app, bind=key)) for key in app.config.get("REPLICA_BIND_KEYS", ())]
+    pools = [(bind, engine.pool) for bind, engine in engines
+             if isinstance(engine.pool, InstrumentedQueuePool)]
+    if not pools:
+        return []
+
+    def metric(name, help_text, metric_type, value):
+        return (f"ratings_db_pool_{name}", help_text, metric_type,
+                [({"bind": bind}, value(pool)) for bind, pool in pools])
+
+    return [
+        metric("size", "Configured pool size.", "gauge", lambda pool: pool.size()),
+        metric("in_use", "Connections checked out right now.", "gauge",
+               lambda pool: pool.checkedout()),
+        metric("idle", "Connections idle in the pool.", "gauge", lambda pool: pool.checkedin()),
+        metric("overflow", "Connections open beyond pool size.", "gauge",
+               lambda pool: pool.overflow()),
+        metric("checkouts_total", "Connection checkouts.", "counter",
+               lambda pool: pool.checkouts),
+        metric("checkout_wait_seconds_total", "Time spent waiting for a connection.",
+               "counter", lambda pool: pool.wait_seconds),
+        metric("checkout_wait_seconds_max", "Longest wait for a connection.",
+               "gauge", lambda pool: pool.max_wait_seconds),
+        metric("checkout_timeouts_total", "Checkouts that gave up waiting.",
+               "counter", lambda pool: pool.timeouts),
+    ]
+
+
+def connect_to_db(flask_app, db_uri="postgresql:///ratings", echo=False,
+                  replica_uris=()):
+    """Point flask_app at db_uri, and optionally at read replicas.
+
+    Pool size, overflow, timeouts, recycling, pre-ping, statement_timeout
+    and application_name come from the DB_* settings in ENGINE_SETTINGS
+    (app.config or environment variables), for each PostgreSQL engine,
+    primary or replica. Crud functions decorated with
+    replica_read spread their queries over replica_uris (or the
+    comma-separated DB_REPLICA_URIS environment variable).
+    """
+
+    if not replica_uris and os.environ.get("DB_REPLICA_URIS"):
+        replica_uris = os.environ["DB_REPLICA_URIS"].split(",")
+
+    replica_binds = {f"replica{n}": uri for n, uri in enumerate(replica_uris)}
+    flask_app.config["SQLALCHEMY_BINDS"] = replica_binds
+    flask_app.config["REPLICA_BIND_KEYS"] = list(replica_binds)
+
     flask_app.config["SQLALCHEMY_DATABASE_URI"] = db_uri
     flask_app.config["SQLALCHEMY_ECHO"] = echo
     flask_app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
@@ -88,14 +461,14 @@ def connect_to_db(flask_app, db_uri="postgresql:///ratings", echo=True):
     db.app = flask_app
     db.init_app(flask_app)
 
-    print("Connected to the db!")
+    flask_app.logger.info("Connected to the db!")
 
 
 if __name__ == "__main__":
-    from server import app
+    from server import create_app
 
-    # Call connect_to_db(app, echo=False) if your program output gets
-    # too annoying; this will tell SQLAlchemy not to print out every
-    # query it executes.
+    # Call create_app({"SQLALCHEMY_ECHO": True}) to have SQLAlchemy print
+    # out every query it executes. (Per-route query counts and timings are
+    # always available at /_metrics.)
 
-    connect_to_db(app)
+    app = create_app()
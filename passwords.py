@@ -0,0 +1,55 @@
+"""Salted, slow password hashing off the request thread.
+
+Hashes are Werkzeug's salted PBKDF2-SHA256 strings. Hashing and checking
+are deliberately expensive, so they run on a small bounded thread pool
+(hashlib releases the GIL while it works): a burst of logins queues here
+instead of pinning every request worker's CPU at once. Size the pool with
+the PASSWORD_HASH_WORKERS environment variable.
+
+The pool caps how much hashing runs at once, not how long a request
+waits: the request thread blocks until its hash is done, for up to
+HASH_TIMEOUT seconds, and then gets HashPoolBusy.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+HASH_METHOD = "pbkdf2:sha256"
+HASH_TIMEOUT = 10  # seconds to wait for a pool worker before giving up
+
+_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 2)),
+    thread_name_prefix="password-hash")
+
+
+class HashPoolBusy(Exception):
+    """A hash waited more than HASH_TIMEOUT seconds for the pool."""
+
+
+def _run(function, *args):
+    future = _pool.submit(function, *args)
+    try:
+        return future.result(HASH_TIMEOUT)
+    except TimeoutError:
+        future.cancel()  # nobody is waiting for it any more
+        raise HashPoolBusy(f"password hashing took over {HASH_TIMEOUT}s") from None
+
+
+def hash_password(password):
+    """Return a salted hash of password to store in User.password_hash.
+
+    Raises HashPoolBusy when the pool is too backed up.
+    """
+
+    return _run(generate_password_hash, password, HASH_METHOD)
+
+
+def check_password(password_hash, password):
+    """Return True if password matches a hash from hash_password().
+
+    Raises HashPoolBusy when the pool is too backed up.
+    """
+
+    return _run(check_password_hash, password_hash, password)
@@ -0,0 +1,33 @@
+"""Script to compile every template ahead of time, at build or deploy time.
+
+    $ python3 precompile_templates.py .jinja_cache
+    $ TEMPLATE_CACHE_DIR=.jinja_cache gunicorn "server:create_app()"
+
+Writes Jinja bytecode for templates/*.html into the directory, so workers
+started with TEMPLATE_CACHE_DIR pointing at it load templates instead of
+compiling them. A template edited since is just compiled again. Run it
+from the directory the app is deployed to: cache entries are keyed on
+the templates' paths.
+"""
+
+import argparse
+import os
+
+import server
+import warmup
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cache_dir", nargs="?",
+                        default=os.environ.get("TEMPLATE_CACHE_DIR", ".jinja_cache"))
+    args = parser.parse_args(argv)
+
+    app = server.create_app({"TEMPLATE_CACHE_DIR": args.cache_dir})
+    count = warmup.load_templates(app)
+
+    print(f"Compiled {count} templates into {args.cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
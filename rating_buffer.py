@@ -0,0 +1,340 @@
+"""Optional write-behind buffering for /rate.
+
+Normally every rating is its own upsert and commit (crud.upsert_rating).
+With a RatingBuffer running, /rate only appends the rating to a local
+journal file and to an in-memory dict keyed by (user_id, movie_id), so
+re-rating a movie before the next flush just replaces the pending score.
+A flusher thread writes everything pending every flush_interval seconds
+(sooner once batch_size ratings are waiting) as one multi-row upsert,
+through crud.import_ratings.
+
+Durability: the journal is appended, and fsync'ed, before a rating is
+acknowledged. (With fsync=False it's only flushed to the OS, which
+survives the process crashing but not the machine.) Each flush first
+moves the journal aside to <journal>.flushing and deletes that file once
+the batch commits. On startup, whatever is left in either file is
+queued again and goes out with the first flush, which deletes it the
+same way; replaying is safe since an upsert of the final score is
+idempotent.
+
+Backpressure: once max_pending ratings are waiting, submit() waits up to
+backpressure_timeout seconds for a flush and then raises BufferFull;
+upsert_rating() then falls back to writing the rating directly (see
+RatingBuffer.bypass).
+
+Turn it on by setting RATING_JOURNAL (see server.create_app), or with
+start(app, journal_path). Each process claims its own journal,
+<journal>.0, <journal>.1 and so on, so workers sharing a RATING_JOURNAL
+don't write to the same file, and a restarted worker picks up what a
+previous one left. Pending ratings are flushed on shutdown (atexit).
+"""
+
+import atexit
+import fcntl
+import itertools
+import os
+import threading
+from contextlib import contextmanager
+
+import crud
+import instrumentation
+from model import db
+
+FLUSH_INTERVAL = 0.5  # seconds
+BATCH_SIZE = 5000  # ratings pending before flushing early
+MAX_PENDING = 20000
+BACKPRESSURE_TIMEOUT = 1.0  # seconds
+
+
+class BufferFull(Exception):
+    """The buffer has too many pending ratings (or is shutting down)."""
+
+
+class RatingBuffer:
+    """A journaled, coalescing queue of ratings, flushed in batches."""
+
+    def __init__(self, app, journal_path, flush_interval=FLUSH_INTERVAL,
+                 batch_size=BATCH_SIZE, max_pending=MAX_PENDING,
+                 backpressure_timeout=BACKPRESSURE_TIMEOUT, fsync=True):
+        self.app = app
+        self.journal_path = journal_path
+        self.flushing_path = journal_path + ".flushing"
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.backpressure_timeout = backpressure_timeout
+        self.fsync = fsync
+
+        self.flushed = 0
+        self._pending = {}
+        self._changed = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closing = False
+        self._journal = open(journal_path, "a")
+        self._thread = None
+
+    def start(self):
+        """Queue any journal left by a previous run, then start flushing.
+
+        The leftover ratings are written by the first flush, which also
+        removes them from the journal files. Nothing here touches the
+        database, so it is safe to call inside a request.
+        """
+
+        with self._changed:
+            self._pending.update(self._read_journals())
+            replayed = len(self._pending)
+        if replayed:
+            self.app.logger.info("Replaying %d buffered ratings from %s",
+                                 replayed, self.journal_path)
+
+        self._thread = threading.Thread(target=self._run, name="rating-buffer",
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id, movie_id, score):
+        """Journal a rating and queue it, replacing any pending score."""
+
+        key = (user_id, movie_id)
+
+        with self._changed:
+            if key not in self._pending and len(self._pending) >= self.max_pending:
+                self._changed.notify_all()  # flush now
+                self._changed.wait_for(
+                    lambda: self._closing or len(self._pending) < self.max_pending,
+                    timeout=self.backpressure_timeout)
+            if self._closing or (key not in self._pending
+                                 and len(self._pending) >= self.max_pending):
+                raise BufferFull()
+
+            self._append(user_id, movie_id, score)
+            self._pending[key] = score
+
+            if len(self._pending) >= self.batch_size:
+                self._changed.notify_all()
+
+    @contextmanager
+    def bypass(self, user_id, movie_id, score):
+        """Hold off flushes while a rating submit() refused is written directly.
+
+        A pending score for the rating is dropped, since flushed after the
+        direct write it would overwrite it, and the new score is journaled
+        in its place so a replay after a crash can't bring the old one back.
+        """
+
+        with self._flush_lock:
+            with self._changed:
+                self._pending.pop((user_id, movie_id), None)
+                if not self._journal.closed:
+                    self._append(user_id, movie_id, score)
+            yield
+
+    def pending_score(self, user_id, movie_id):
+        """Return the score waiting to be written for this rating, or None."""
+
+        with self._changed:
+            return self._pending.get((user_id, movie_id))
+
+    def metrics(self):
+        """Return metrics for instrumentation.register_collector."""
+
+        return [("ratings_buffer_pending", "Ratings waiting to be written.", "gauge",
+                 [({}, len(self._pending))]),
+                ("ratings_buffer_flushed_total", "Buffered ratings written.", "counter",
+                 [({}, self.flushed)])]
+
+    def flush(self):
+        """Write every pending rating now; return how many were written.
+
+        Must run inside an app context.
+        """
+
+        with self._flush_lock:
+            with self._changed:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, {}
+                self._rotate_journal()
+                self._changed.notify_all()
+
+            try:
+                self._write(batch)
+            except Exception:
+                # Keep the ratings (and their journal) for the next try;
+                # anything re-rated meanwhile is newer and wins.
+                with self._changed:
+                    for key, score in batch.items():
+                        self._pending.setdefault(key, score)
+                raise
+
+            self._remove(self.flushing_path)
+            self.flushed += len(batch)
+            return len(batch)
+
+    def close(self):
+        """Stop accepting ratings, flush what's pending and stop the thread."""
+
+        with self._changed:
+            if self._closing:
+                return
+            self._closing = True
+            self._changed.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+        else:
+            with self.app.app_context():
+                self.flush()
+
+        self._journal.close()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(
+                    lambda: self._closing or len(self._pending) >= self.batch_size,
+                    timeout=self.flush_interval)
+                closing = self._closing
+
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception("Flushing buffered ratings failed")
+                finally:
+                    db.session.remove()
+
+            if closing:
+                return
+
+    def _write(self, scores):
+        """Upsert {(user_id, movie_id): score} in one transaction."""
+
+        if not scores:
+            return 0
+
+        rows = [crud.ImportedRating(None, user_id, None, movie_id, score)
+                for (user_id, movie_id), score in scores.items()]
+        try:
+            _, errors = crud.import_ratings(rows)
+        except Exception:
+            db.session.rollback()
+            raise
+
+        for _, error in errors:
+            self.app.logger.warning("Dropped a buffered rating: %s", error)
+
+        return len(rows)
+
+    def _append(self, user_id, movie_id, score):
+        """Journal one rating. Call locked."""
+
+        self._journal.write(f"{user_id}\t{movie_id}\t{score}\n")
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _rotate_journal(self):
+        """Move the journal's entries to the .flushing file. Call locked."""
+
+        self._journal.close()
+        if os.path.exists(self.flushing_path):
+            # A failed flush left entries behind; keep them, older first.
+            with open(self.journal_path) as journal, open(self.flushing_path, "a") as f:
+                f.write(journal.read())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.flushing_path)
+        self._journal = open(self.journal_path, "a")
+
+    def _read_journals(self):
+        scores = {}
+        for path in (self.flushing_path, self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path) as f:
+                for line in f:
+                    try:
+                        user_id, movie_id, score = map(int, line.split("\t"))
+                    except ValueError:
+                        continue  # a line torn by a crash mid-write
+                    scores[(user_id, movie_id)] = score
+        return scores
+
+    def _remove(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+_buffer = None
+_journal_lock = None
+
+
+def claim_journal(journal_path):
+    """Return the first of journal_path.0, .1, ... no other process holds.
+
+    The claim is an exclusive lock on a .lock file next to the journal,
+    held until this process exits.
+    """
+
+    global _journal_lock
+
+    for slot in itertools.count():
+        path = f"{journal_path}.{slot}"
+        lock = open(path + ".lock", "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        _journal_lock = lock
+        return path
+
+
+def start(app, journal_path, **options):
+    """Start write-behind buffering for app's /rate; returns the buffer.
+
+    journal_path is claimed for this process (see claim_journal).
+    """
+
+    global _buffer
+
+    _buffer = RatingBuffer(app, claim_journal(journal_path), **options)
+    _buffer.start()
+    atexit.register(_buffer.close)
+    instrumentation.register_collector("rating_buffer", _buffer.metrics)
+
+    return _buffer
+
+
+def get_buffer():
+    """Return the running RatingBuffer, or None when writes aren't buffered."""
+
+    return _buffer
+
+
+def upsert_rating(user_id, movie_id, score: int):
+    """Like crud.upsert_rating, but through the buffer when it's running.
+
+    Returns (old_score, movie_title). The previous score is the pending
+    one if there is one, else read from the database (a read, no commit).
+    """
+
+    if _buffer is None:
+        return crud.upsert_rating(user_id, movie_id, score)
+
+    movie = crud.get_movie_by_id(movie_id)
+    if movie is None:
+        return crud.upsert_rating(user_id, movie_id, score)
+
+    old_score = _buffer.pending_score(user_id, movie_id)
+    if old_score is None:
+        old_score = crud.get_rating_score(user_id, movie_id)
+
+    try:
+        _buffer.submit(user_id, movie_id, score)
+    except BufferFull:
+        with _buffer.bypass(user_id, movie_id, score):
+            crud.upsert_rating(user_id, movie_id, score)
+
+    return old_score, movie.title
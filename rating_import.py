@@ -0,0 +1,143 @@
+"""Bulk rating imports, for partners sending ratings from elsewhere.
+
+Ratings arrive as NDJSON (one JSON object per line) or CSV (with a header
+row), each record naming a user by "user_id" or "email", plus a
+"movie_id" and a "score" from 0-5:
+
+    {"email": "someone@example.com", "movie_id": 12, "score": 4}
+
+    user_id,movie_id,score
+    42,12,4
+
+Records are parsed and validated as they stream in, then written
+CHUNK_SIZE at a time through crud.import_ratings; each chunk is its own
+transaction. Bad records don't stop the import, they are reported by
+line number instead.
+
+The same import is served at POST /ratings/import (see server.py) and run
+from the command line by import_ratings.py.
+"""
+
+import csv
+import json
+
+import crud
+
+CHUNK_SIZE = 5000
+MAX_REPORTED_ERRORS = 1000  # the rest are only counted
+
+FORMATS = ("ndjson", "csv")
+
+
+def parse_records(lines, format):
+    """Yield (line_number, record, error) for each record in lines.
+
+    record is a dict (None if the line couldn't be parsed, in which case
+    error says why).
+    """
+
+    if format == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_number, None, "Not valid JSON"
+            continue
+        if isinstance(record, dict):
+            yield line_number, record, None
+        else:
+            yield line_number, None, "Expected a JSON object"
+
+
+def _integer(value, name):
+    if isinstance(value, bool):
+        raise ValueError(f"{name} must be an integer")
+    if isinstance(value, str):
+        value = value.strip()
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer") from None
+    if isinstance(value, float) and value != number:
+        raise ValueError(f"{name} must be an integer")
+    return number
+
+
+def to_imported_rating(line_number, record):
+    """Validate one record and return it as a crud.ImportedRating.
+
+    Raises ValueError with a message for the error report.
+    """
+
+    user_id = record.get("user_id")
+    email = record.get("email")
+    if user_id not in (None, ""):
+        user_id, email = _integer(user_id, "user_id"), None
+    elif isinstance(email, str) and email.strip():
+        user_id, email = None, email.strip()
+    else:
+        raise ValueError("Needs a user_id or an email")
+
+    movie_id = _integer(record.get("movie_id"), "movie_id")
+
+    score = _integer(record.get("score"), "score")
+    if score not in crud.SCORES:
+        raise ValueError("score must be from 0-5")
+
+    return crud.ImportedRating(line_number, user_id, email, movie_id, score)
+
+
+def import_lines(lines, format="ndjson", chunk_size=CHUNK_SIZE):
+    """Import every record in lines and return a report dict.
+
+    The report counts records received, ratings created, updated and
+    unchanged, and records that failed; "errors" lists the first
+    MAX_REPORTED_ERRORS failures as {"line": ..., "error": ...}.
+    """
+
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format: {format!r}")
+
+    report = {"received": 0, "created": 0, "updated": 0, "unchanged": 0,
+              "failed": 0, "errors": []}
+
+    def fail(line_number, error):
+        report["failed"] += 1
+        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+            report["errors"].append({"line": line_number, "error": error})
+
+    def flush(chunk):
+        counts, errors = crud.import_ratings(chunk)
+        for key, count in counts.items():
+            report[key] += count
+        for line_number, error in errors:
+            fail(line_number, error)
+
+    chunk = []
+    for line_number, record, error in parse_records(lines, format):
+        report["received"] += 1
+        if error is None:
+            try:
+                chunk.append(to_imported_rating(line_number, record))
+            except ValueError as invalid:
+                error = str(invalid)
+        if error is not None:
+            fail(line_number, error)
+        elif len(chunk) == chunk_size:
+            flush(chunk)
+            chunk = []
+
+    if chunk:
+        flush(chunk)
+
+    report["errors"].sort(key=lambda error: error["line"])
+
+    return report
+
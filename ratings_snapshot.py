@@ -0,0 +1,45 @@
+"""Script to save a memory-mappable snapshot of the ratings table.
+
+    $ python3 ratings_snapshot.py snapshots/ratings
+    $ psql ratings -c "COPY ratings (user_id, movie_id, score) TO STDOUT" > ratings.tsv
+    $ python3 ratings_snapshot.py snapshots/ratings --from-copy ratings.tsv
+
+Open the snapshot with ratings_store.RatingsStore.load(directory).
+"""
+
+import argparse
+import sys
+import time
+
+import server
+from ratings_store import RatingsStore
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="where to write the snapshot")
+    parser.add_argument("--from-copy", metavar="PATH",
+                        help="build from a COPY dump instead of the database")
+    parser.add_argument("--db-uri", default="postgresql:///ratings")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+
+    if args.from_copy:
+        with open(args.from_copy, "rb") as f:
+            store = RatingsStore.from_copy(f)
+    else:
+        app = server.create_app({"DATABASE_URI": args.db_uri})
+        with app.app_context():
+            store = RatingsStore.from_database()
+
+    store.save(args.directory)
+
+    print(f"Saved {store.rating_count} ratings ({store.nbytes / 2**20:.1f}MB) "
+          f"to {args.directory} in {time.perf_counter() - start:.1f}s")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""A compact, columnar copy of the ratings table, for analytics.
+
+RatingsStore keeps every rating twice, as plain NumPy arrays:
+
+- grouped by movie: movie_index (the movie ids), movie_offsets, and the
+  raters' ids and scores in movie_users / movie_scores, so movie
+  movie_index[i]'s ratings are movie_users[movie_offsets[i]:movie_offsets[i + 1]];
+- grouped by user, the same way: user_index, user_offsets, user_movies
+  and user_scores.
+
+That's 10 bytes a rating (int32 ids, int8 scores), so 100M ratings take
+about 1GB, against 1KB+ for each Rating object. Per-movie and per-user
+stats are computed with vectorized reductions over those groups.
+
+Build a store from the database (COPY on PostgreSQL), from the text
+output of a COPY ratings (user_id, movie_id, score) TO ... dump, or from
+arrays, then save() it as a snapshot. RatingsStore.load(directory)
+memory-maps a snapshot, so opening one is instant and every process on a
+machine shares the same pages:
+
+    $ python3 ratings_snapshot.py snapshots/ratings
+    >>> store = RatingsStore.load("snapshots/ratings")
+    >>> store.movie_stats().means
+"""
+
+import os
+import tempfile
+import warnings
+from collections import namedtuple
+
+import numpy as np
+
+from model import db, SCORES
+
+COPY_SQL = "COPY ratings (user_id, movie_id, score) TO STDOUT"
+COPY_CHUNK_BYTES = 64 * 2 ** 20  # COPY text parsed per step
+
+ScoreStats = namedtuple("ScoreStats",
+                        ["ids", "counts", "means", "stddevs", "medians", "histograms"])
+"""Per-movie or per-user score stats, as arrays lined up with ids.
+histograms has one row per id and one column per score; means, stddevs
+and medians are NaN for ids with no ratings (there aren't any in a
+store, but slices of one may have them)."""
+
+
+def _grouped(keys, values, scores):
+    """Sort (values, scores) by keys; return index, offsets, values, scores."""
+
+    order = np.argsort(keys.astype(np.int64) << 32 | values.astype(np.int64),
+                       kind="stable")
+    index, counts = np.unique(keys[order], return_counts=True)
+    offsets = np.zeros(len(index) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return index, offsets, values[order], scores[order]
+
+
+def _parse_copy(text, first_line):
+    """Parse COPY lines of three integers into an (n, 3) int32 array.
+
+    Raises ValueError naming the first line that isn't three integers
+    (such as one with a \\N), where np.fromstring alone would stop there
+    with just a warning (or, in newer NumPy, an error that doesn't say
+    where).
+    """
+
+    if text and not text.endswith("\n"):
+        text += "\n"
+    data = np.frombuffer(text.encode(), dtype=np.uint8)
+    line_ends = np.flatnonzero(data == ord("\n"))
+    separators = np.flatnonzero((data == ord("\t")) | (data == ord(",")))
+    fields = np.bincount(np.searchsorted(line_ends, separators),
+                         minlength=len(line_ends)) + 1
+
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)  # "unmatched data"
+            values = np.fromstring(text.replace(",", " "), dtype=np.int32, sep=" ")
+    except ValueError:
+        values = None
+
+    if values is None or len(values) != 3 * len(line_ends) or (fields != 3).any():
+        for number, line in enumerate(text.splitlines(), first_line):
+            if not _is_rating_line(line):
+                raise ValueError(f"COPY line {number}: expected user_id, movie_id "
+                                 f"and score, got {line!r}")
+        raise ValueError("COPY output could not be parsed")
+
+    return values.reshape(-1, 3)
+
+
+def _is_rating_line(line):
+    fields = line.replace(",", "\t").split("\t")
+    try:
+        return len(fields) == 3 and all(int(field) >= 0 for field in fields)
+    except ValueError:
+        return False
+
+
+def _stats(ids, histograms):
+    counts = histograms.sum(axis=1)
+    score_values = np.arange(len(SCORES))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = histograms @ score_values / counts
+        squares = histograms @ (score_values ** 2) / counts
+        stddevs = np.sqrt(np.maximum(squares - means ** 2, 0))
+
+    # The median is the mean of the two middle scores (the same one for an
+    # odd count); each is the first score whose running count passes it.
+    running = np.cumsum(histograms, axis=1)
+    lower = (running <= ((counts - 1) // 2)[:, None]).sum(axis=1)
+    upper = (running <= (counts // 2)[:, None]).sum(axis=1)
+    medians = np.where(counts > 0, (lower + upper) / 2, np.nan)
+
+    return ScoreStats(ids, counts, means, stddevs, medians, histograms)
+
+
+class RatingsStore:
+    """Every rating, grouped by movie and by user, in NumPy arrays."""
+
+    ARRAYS = ("movie_index", "movie_offsets", "movie_users", "movie_scores",
+              "user_index", "user_offsets", "user_movies", "user_scores")
+
+    def __init__(self, **arrays):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def from_arrays(cls, user_ids, movie_ids, scores):
+        """Build a store from parallel arrays of ratings."""
+
+        user_ids = np.asarray(user_ids, dtype=np.int32)
+        movie_ids = np.asarray(movie_ids, dtype=np.int32)
+        scores = np.asarray(scores, dtype=np.int8)
+
+        movie_index, movie_offsets, movie_users, movie_scores = _grouped(
+            movie_ids, user_ids, scores)
+        user_index, user_offsets, user_movies, user_scores = _grouped(
+            user_ids, movie_ids, scores)
+
+        return cls(movie_index=movie_index, movie_offsets=movie_offsets,
+                   movie_users=movie_users, movie_scores=movie_scores,
+                   user_index=user_index, user_offsets=user_offsets,
+                   user_movies=user_movies, user_scores=user_scores)
+
+    @classmethod
+    def from_copy(cls, f, chunk_bytes=COPY_CHUNK_BYTES):
+        """Build a store from COPY output: user_id, movie_id, score lines.
+
+        f is a file opened in text or binary mode. Tab (COPY's default) and
+        comma (FORMAT csv, without a header) separated lines both work.
+        Raises ValueError for a line that isn't three integers, e.g. a
+        NULL id.
+        """
+
+        chunks = []
+        line_number = 1
+        while True:
+            lines = f.readlines(chunk_bytes)
+            if not lines:
+                break
+            text = "".join(line if isinstance(line, str) else line.decode()
+                           for line in lines)
+            chunks.append(_parse_copy(text, line_number))
+            line_number += len(lines)
+
+        triples = np.concatenate(chunks) if chunks else np.zeros((0, 3), dtype=np.int32)
+
+        return cls.from_arrays(triples[:, 0], triples[:, 1], triples[:, 2])
+
+    @classmethod
+    def from_database(cls):
+        """Build a store from the ratings table. Must run in an app context.
+
+        PostgreSQL streams the table out with COPY through a temporary file;
+        other databases go through recommender.load_ratings().
+        """
+
+        if db.engine.dialect.name != "postgresql":
+            import recommender
+            return cls.from_arrays(*recommender.load_ratings())
+
+        connection = db.engine.raw_connection()
+        try:
+            with tempfile.TemporaryFile("w+b") as dump:
+                connection.cursor().copy_expert(COPY_SQL, dump)
+                connection.commit()
+                dump.seek(0)
+                return cls.from_copy(dump)
+        finally:
+            connection.close()
+
+    def save(self, directory):
+        """Write the store to directory, one .npy file per array."""
+
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Open a saved store, memory-mapped (read-only) unless mmap=False."""
+
+        return cls(**{name: np.load(os.path.join(directory, f"{name}.npy"),
+                                    mmap_mode="r" if mmap else None)
+                      for name in cls.ARRAYS})
+
+    @property
+    def rating_count(self):
+        return len(self.movie_scores)
+
+    @property
+    def nbytes(self):
+        """Memory held by the arrays, in bytes."""
+
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def triples(self):
+        """Return (user_ids, movie_ids, scores) arrays of every rating.
+
+        E.g. recommender.ItemItemModel(*store.triples()).
+        """
+
+        user_ids = np.repeat(self.user_index, np.diff(self.user_offsets))
+
+        return user_ids, np.asarray(self.user_movies), np.asarray(self.user_scores)
+
+    def _position(self, index, key):
+        position = int(np.searchsorted(index, key))
+        if position < len(index) and index[position] == key:
+            return position
+        return None
+
+    def ratings_of_movie(self, movie_id):
+        """Return (user_ids, scores) of one movie's ratings."""
+
+        position = self._position(self.movie_index, movie_id)
+        if position is None:
+            return np.zeros(0, np.int32), np.zeros(0, np.int8)
+
+        start, stop = self.movie_offsets[position], self.movie_offsets[position + 1]
+        return self.movie_users[start:stop], self.movie_scores[start:stop]
+
+    def ratings_by_user(self, user_id):
+        """Return (movie_ids, scores) of one user's ratings."""
+
+        position = self._position(self.user_index, user_id)
+        if position is None:
+            return np.zeros(0, np.int32), np.zeros(0, np.int8)
+
+        start, stop = self.user_offsets[position], self.user_offsets[position + 1]
+        return self.user_movies[start:stop], self.user_scores[start:stop]
+
+    @staticmethod
+    def _histograms(offsets, scores):
+        starts = offsets[:-1]
+        histograms = np.zeros((len(starts), len(SCORES)), dtype=np.int64)
+        if len(scores) == 0:
+            return histograms
+
+        for score in SCORES:
+            histograms[:, score] = np.add.reduceat(scores == score, starts, dtype=np.int64)
+        return histograms
+
+    def movie_stats(self):
+        """Return ScoreStats for every movie."""
+
+        return _stats(self.movie_index, self._histograms(self.movie_offsets, self.movie_scores))
+
+    def user_stats(self):
+        """Return ScoreStats for every user (e.g. .means, per-user mean scores)."""
+
+        return _stats(self.user_index, self._histograms(self.user_offsets, self.user_scores))
+
+    def co_rating_counts(self, movie_id, count=None):
+        """Return (movie_ids, counts) of how many of movie_id's raters rated
+        each other movie, most co-rated first."""
+
+        raters, _ = self.ratings_of_movie(movie_id)
+        positions = np.searchsorted(self.user_index, raters)
+        starts = self.user_offsets[positions]
+        lengths = self.user_offsets[positions + 1] - starts
+
+        # Indexes of all of those users' ratings, without a Python loop.
+        first = np.cumsum(lengths) - lengths
+        rated = self.user_movies[np.repeat(starts - first, lengths)
+                                 + np.arange(lengths.sum())]
+
+        counts = np.bincount(np.searchsorted(self.movie_index, rated),
+                             minlength=len(self.movie_index))
+        own = self._position(self.movie_index, movie_id)
+        if own is not None:
+            counts[own] = 0
+
+        order = np.argsort(-counts, kind="stable")[:count]
+        order = order[counts[order] > 0]
+
+        return self.movie_index[order], counts[order]
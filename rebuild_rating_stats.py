@@ -0,0 +1,40 @@
+"""Script to rebuild (or just verify) the rating summaries on movies.
+
+The rating count, sum and per-score histogram on each movie are kept up
+to date by crud on every write. If they ever drift from the ratings
+table (manual SQL, a restored backup...), run:
+
+    $ python3 rebuild_rating_stats.py           # repair drifted movies
+    $ python3 rebuild_rating_stats.py --verify  # report only, exit 1 on drift
+"""
+
+import argparse
+import sys
+
+import crud
+import server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--verify", action="store_true",
+                        help="only report drifted movies, don't rewrite them")
+    args = parser.parse_args(argv)
+
+    app = server.create_app()
+
+    with app.app_context():
+        drifted = crud.rebuild_movie_rating_stats(verify_only=args.verify)
+
+    if not drifted:
+        print("All movie rating summaries match the ratings table.")
+        return 0
+
+    action = "Drifted" if args.verify else "Rebuilt"
+    print(f"{action} rating summaries for {len(drifted)} movie(s): {drifted}")
+
+    return 1 if args.verify else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""Item-item collaborative filtering over the ratings table.
+
+The model is built from (user_id, movie_id, score) triples:
+
+1. Ratings go into a sparse users x movies matrix, and each user's mean
+   score is subtracted from their ratings (so a harsh rater's 3 counts
+   the same as a generous rater's 4).
+2. Movie columns are scaled to unit length; the cosine similarity of two
+   movies is then just the dot product of their columns.
+3. For every movie we keep only its top-k most similar movies. They are
+   computed a block of movies at a time, so the full movies x movies
+   similarity matrix never exists at once.
+
+Requests only ever read the current model. rebuild() builds a new one and
+swaps it in, and start_background_refresh() does that on a schedule from a
+daemon thread, so building never blocks a request.
+"""
+
+import hashlib
+import threading
+import time
+
+import numpy as np
+from scipy import sparse
+
+from model import db, Rating, replica_read
+
+NEIGHBORS = 20  # similar movies kept per movie
+BLOCK_CELLS = 2 ** 23  # similarity scores held at once while building (32MB)
+FETCH_SIZE = 100000  # rating rows fetched per round trip while loading
+
+
+class ItemItemModel:
+    """Top-k similar movies per movie, plus each user's centered ratings."""
+
+    def __init__(self, user_ids, movie_ids, scores, neighbors=NEIGHBORS,
+                 block_cells=BLOCK_CELLS):
+        self._version = None
+        self.user_index, users = np.unique(user_ids, return_inverse=True)
+        self.movie_index, movies = np.unique(movie_ids, return_inverse=True)
+
+        ratings = sparse.csr_matrix(
+            (np.asarray(scores, dtype=np.float32), (users, movies)),
+            shape=(len(self.user_index), len(self.movie_index)))
+
+        # Mean-center each user's ratings (rows).
+        counts = np.diff(ratings.indptr)
+        means = np.asarray(ratings.sum(axis=1)).ravel() / np.maximum(counts, 1)
+        ratings.data -= np.repeat(means, counts).astype(np.float32)
+        self.user_ratings = ratings
+
+        # Unit-length movie columns, so X.T @ X is cosine similarity.
+        columns = ratings.tocsc()
+        norms = np.sqrt(np.asarray(columns.multiply(columns).sum(axis=0)).ravel())
+        normalized = columns @ sparse.diags(
+            1 / np.where(norms > 0, norms, 1)).astype(np.float32)
+        normalized = normalized.tocsc()
+
+        movie_count = len(self.movie_index)
+        k = min(neighbors, max(movie_count - 1, 0))
+        self.neighbors = np.zeros((movie_count, k), dtype=np.int32)
+        self.similarities = np.zeros((movie_count, k), dtype=np.float32)
+
+        if k == 0:
+            return
+
+        block_size = max(1, block_cells // movie_count)
+        for start in range(0, movie_count, block_size):
+            stop = min(start + block_size, movie_count)
+            block = (normalized[:, start:stop].T @ normalized).toarray()
+            block[np.arange(stop - start), np.arange(start, stop)] = 0  # not yourself
+            np.maximum(block, 0, out=block)  # only keep positive neighbors
+            top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+            top_similarities = np.take_along_axis(block, top, axis=1)
+            order = np.argsort(-top_similarities, axis=1)
+            self.neighbors[start:stop] = np.take_along_axis(top, order, axis=1)
+            self.similarities[start:stop] = np.take_along_axis(
+                top_similarities, order, axis=1)
+
+    @property
+    def version(self):
+        """A hash of everything the model answers with.
+
+        It tells pages built from different models apart, and since it
+        depends only on the data, every worker gets the same version from
+        the same ratings, and a rebuild from unchanged ratings keeps it.
+        """
+
+        if self._version is None:
+            digest = hashlib.blake2b(digest_size=8)
+            for array in (self.user_index, self.movie_index, self.neighbors,
+                          self.similarities, self.user_ratings.indptr,
+                          self.user_ratings.indices, self.user_ratings.data):
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self._version = int.from_bytes(digest.digest(), "big")
+
+        return self._version
+
+    @property
+    def nbytes(self):
+        """Approximate memory held by the model, in bytes."""
+
+        return (self.user_index.nbytes + self.movie_index.nbytes
+                + self.neighbors.nbytes + self.similarities.nbytes
+                + self.user_ratings.data.nbytes + self.user_ratings.indices.nbytes
+                + self.user_ratings.indptr.nbytes)
+
+    def _position(self, index, key):
+        position = np.searchsorted(index, key)
+        if position < len(index) and index[position] == key:
+            return position
+        return None
+
+    def similar_movies(self, movie_id, count=10):
+        """Return [(movie_id, similarity), ...] for the most similar movies."""
+
+        position = self._position(self.movie_index, movie_id)
+        if position is None:
+            return []
+
+        return [(int(self.movie_index[neighbor]), float(similarity))
+                for neighbor, similarity in zip(self.neighbors[position][:count],
+                                                self.similarities[position][:count])
+                if similarity > 0]
+
+    def recommend_for_user(self, user_id, count=10):
+        """Return [(movie_id, score), ...] the user hasn't rated yet.
+
+        A candidate's score is the sum, over the user's rated movies it is
+        a neighbor of, of similarity times the user's centered rating.
+        """
+
+        position = self._position(self.user_index, user_id)
+        if position is None:
+            return []
+
+        row = self.user_ratings.getrow(position)
+        rated, centered_scores = row.indices, row.data
+
+        candidate_scores = np.zeros(len(self.movie_index), dtype=np.float32)
+        np.add.at(candidate_scores, self.neighbors[rated].ravel(),
+                  (self.similarities[rated] * centered_scores[:, None]).ravel())
+        candidate_scores[rated] = 0
+
+        count = min(count, len(candidate_scores))
+        if count == 0:
+            return []
+        best = np.argpartition(-candidate_scores, count - 1)[:count]
+        best = best[np.argsort(-candidate_scores[best])]
+
+        return [(int(self.movie_index[movie]), float(candidate_scores[movie]))
+                for movie in best if candidate_scores[movie] > 0]
+
+
+@replica_read
+def load_ratings():
+    """Return (user_ids, movie_ids, scores) arrays for every rating.
+
+    Rows are streamed from a server-side cursor in FETCH_SIZE chunks
+    instead of being hydrated as Rating objects.
+    """
+
+    result = db.session.execute(
+        db.select(Rating.user_id, Rating.movie_id, Rating.score).execution_options(
+            stream_results=True))
+
+    chunks = [np.array(rows, dtype=np.int32).reshape(-1, 3)
+              for rows in iter(lambda: result.fetchmany(FETCH_SIZE), [])]
+    triples = np.concatenate(chunks) if chunks else np.zeros((0, 3), dtype=np.int32)
+
+    return triples[:, 0], triples[:, 1], triples[:, 2]
+
+
+_model = None
+_rebuild_lock = threading.Lock()
+
+
+def get_model():
+    """Return the current ItemItemModel, or None before the first build."""
+
+    return _model
+
+
+def rebuild():
+    """Build a fresh model from the ratings table and swap it in.
+
+    Must run inside an app context. Concurrent calls are skipped rather
+    than queued; requests keep using the previous model meanwhile.
+    """
+
+    global _model
+
+    if not _rebuild_lock.acquire(blocking=False):
+        return _model
+
+    try:
+        new_model = ItemItemModel(*load_ratings())
+        new_model.version  # hash it here rather than in a request
+        db.session.remove()
+        _model = new_model
+        return new_model
+    finally:
+        _rebuild_lock.release()
+
+
+def refresh_forever(app, interval=15 * 60):
+    """Rebuild the model now and every interval seconds; never returns."""
+
+    while True:
+        with app.app_context():
+            try:
+                rebuild()
+            except Exception:
+                app.logger.exception("Rebuilding recommendations failed")
+        time.sleep(interval)
+
+
+def start_background_refresh(app, interval=15 * 60):
+    """Rebuild the model now and every interval seconds, off-thread."""
+
+    thread = threading.Thread(target=refresh_forever, args=(app, interval),
+                              name="recommender", daemon=True)
+    thread.start()
+
+    return thread
+
+
+def model_version():
+    """The current model's version (0 until a model is built)."""
+
+    model = get_model()
+
+    return 0 if model is None else model.version
+
+
+def similar_movies(movie_id, count=10):
+    """Movie ids most similar to movie_id (empty until a model is built)."""
+
+    model = get_model()
+    if model is None:
+        return []
+
+    return [movie_id for movie_id, _ in model.similar_movies(movie_id, count)]
+
+
+def recommend_for_user(user_id, count=10):
+    """Movie ids to recommend to user_id (empty until a model is built)."""
+
+    model = get_model()
+    if model is None:
+        return []
+
+    return [movie_id for movie_id, _ in model.recommend_for_user(user_id, count)]
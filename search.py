@@ -0,0 +1,168 @@
+"""Movie search over titles and overviews.
+
+On PostgreSQL, crud.search_movies queries the generated search_vector
+column and the trigram index on titles (see model.py). This module holds
+the parts shared with the fallback used everywhere else: turning a query
+into terms, and SearchIndex, an in-process inverted index over the
+catalog that ranks the way the PostgreSQL query roughly does:
+
+- every query term must match (the last one may be a prefix, as if the
+  user is still typing);
+- a term with no exact match falls back to title words spelled similarly
+  (trigram similarity), for typos;
+- matches in the title count TITLE_WEIGHT times a match in the overview,
+  and rare terms count more than common ones.
+
+get_index() keeps one SearchIndex per process and rebuilds it when movies
+are added.
+"""
+
+import heapq
+import math
+import re
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from sqlalchemy import func
+
+from model import db, Movie
+
+TITLE_WEIGHT = 3
+MIN_SIMILARITY = 0.3  # pg_trgm's default threshold
+FETCH_SIZE = 10000  # movies loaded per round trip while indexing
+
+STOP_WORDS = frozenset(
+    "a an and are as at be but by for from has he her his in is it its of on "
+    "or she that the their they this to was were which who will with".split())
+
+
+def tokenize(text):
+    """Return the lowercased words of text, minus stop words."""
+
+    return [word for word in re.findall(r"\w+", (text or "").lower())
+            if word not in STOP_WORDS]
+
+
+def to_tsquery(query):
+    """Return query as a to_tsquery() string: every term, the last one a prefix.
+
+    Returns "" if the query has no searchable terms.
+    """
+
+    terms = tokenize(query)
+    if not terms:
+        return ""
+
+    return " & ".join(terms[:-1] + [terms[-1] + ":*"])
+
+
+def trigrams(word):
+    """Return the set of trigrams pg_trgm would extract from one word."""
+
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """An inverted index from terms to the movies they appear in."""
+
+    def __init__(self, movies):
+        """Index movies, an iterable of (movie_id, title, overview)."""
+
+        self.postings = defaultdict(lambda: defaultdict(int))
+        self.title_terms_by_trigram = defaultdict(set)
+        self.movie_count = 0
+
+        for movie_id, title, overview in movies:
+            self.movie_count += 1
+            for term in tokenize(title):
+                self.postings[term][movie_id] += TITLE_WEIGHT
+                for trigram in trigrams(term):
+                    self.title_terms_by_trigram[trigram].add(term)
+            for term in tokenize(overview):
+                self.postings[term][movie_id] += 1
+
+        self.vocabulary = sorted(self.postings)
+
+    def _prefixed(self, prefix):
+        start = bisect_left(self.vocabulary, prefix)
+        for term in self.vocabulary[start:]:
+            if not term.startswith(prefix):
+                break
+            yield term
+
+    def _similar_title_terms(self, term):
+        wanted = trigrams(term)
+        candidates = set().union(*(self.title_terms_by_trigram.get(trigram, ())
+                                   for trigram in wanted))
+        for candidate in candidates:
+            theirs = trigrams(candidate)
+            if len(wanted & theirs) / len(wanted | theirs) >= MIN_SIMILARITY:
+                yield candidate
+
+    def _expand(self, term, is_last):
+        """Return the indexed terms a query term matches."""
+
+        matches = {term} if term in self.postings else set()
+        if is_last:
+            matches.update(self._prefixed(term))
+        if not matches:
+            matches.update(self._similar_title_terms(term))
+        return matches
+
+    def search(self, query, limit=None):
+        """Return the ids of the (first limit) movies matching query, best first."""
+
+        terms = tokenize(query)
+        scores = None
+
+        for position, term in enumerate(terms):
+            term_scores = {}
+            for match in self._expand(term, position == len(terms) - 1):
+                postings = self.postings[match]
+                idf = math.log(1 + self.movie_count / len(postings))
+                for movie_id, weight in postings.items():
+                    term_scores[movie_id] = max(term_scores.get(movie_id, 0), weight * idf)
+
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {movie_id: score + term_scores[movie_id]
+                          for movie_id, score in scores.items() if movie_id in term_scores}
+            if not scores:
+                return []
+
+        scores = scores or {}
+
+        def rank(movie_id):
+            return -scores[movie_id], movie_id
+
+        if limit is None:
+            return sorted(scores, key=rank)
+        return heapq.nsmallest(limit, scores, key=rank)
+
+
+_index = None
+_index_signature = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Return a SearchIndex of the current catalog, building it if needed.
+
+    Movies are only ever added, so the index is rebuilt whenever the count
+    or the highest movie_id changes. Must run inside an app context.
+    """
+
+    global _index, _index_signature
+
+    signature = db.session.query(func.count(Movie.movie_id), func.max(Movie.movie_id)).one()
+
+    with _index_lock:
+        if _index is None or signature != _index_signature:
+            movies = db.session.query(
+                Movie.movie_id, Movie.title, Movie.overview).yield_per(FETCH_SIZE)
+            _index = SearchIndex(movies)
+            _index_signature = signature
+        return _index
@@ -6,8 +6,8 @@ import os
 # JEM: Needed to open files, delete files...
 import json
 # So we can load the data in data/movies.json.
-from random import choice, randint
-# choice is a function that takes in a list and returns a random element in the list. 
+from random import randint, sample
+# sample is a function that takes in a list and returns k distinct random elements from it.
 # randint will return a random number within a certain range. 
 # You’ll use both to generate fake users and ratings
 from datetime import datetime
@@ -21,7 +21,7 @@ import server
 os.system("dropdb ratings")  # This is just like:  $ dropdb ratings
 os.system("createdb ratings")
 
-model.connect_to_db(server.app)
+app = server.create_app()
 model.db.create_all()
 """Remember — we imported model and server instead of importing individual functions.
 If we had written from model import db, we'd be able to access db.  (on line 17)
@@ -84,6 +84,7 @@ for movie in movie_data:
 
 model.db.session.add_all(movies_in_db)
 model.db.session.commit() 
+crud.invalidate_movie_catalog()  # Any cached movies are from the old database.
 
 """
 Finally, we'll generate 10 users. One problem — each user needs a unique email address. 
@@ -101,8 +102,8 @@ for n in range(SEED_USERS):
     model.db.session.add(one_user_instance)
     
     ratings_list = []
-    for z in range(SEED_RATINGS):
-        one_random_movie_instance = choice(movies_in_db)
+    # sample() picks distinct movies: one rating per user per movie.
+    for one_random_movie_instance in sample(movies_in_db, SEED_RATINGS):
         one_rating_instance = crud.create_rating(
             one_user_instance, one_random_movie_instance, randint(0, 5))
         ratings_list.append(one_rating_instance)
@@ -1,26 +1,144 @@
-"""Server for movie ratings app."""
+"""Server for movie ratings app.
 
-from flask import (Flask, render_template, request, flash, session,
-                   redirect)
-from model import connect_to_db
+Build the app with create_app(), e.g. gunicorn "server:create_app()".
+Nothing heavy happens on import: the recommender (NumPy, SciPy) is
+imported by the views that use it, and pyarrow by Parquet exports.
+
+Workers start faster with the templates precompiled at build or deploy
+time (python3 precompile_templates.py) into TEMPLATE_CACHE_DIR, and with
+WARMUP on, so the connection pool and the first catalog page are ready
+before the first request rather than during it (see warmup.py).
+"""
+
+import hmac
+import io
+import os
+import threading
+
+from flask import (Blueprint, Flask, current_app, render_template, request, flash,
+                   session, redirect, abort, jsonify, Response, stream_with_context)
+from jinja2 import FileSystemBytecodeCache, StrictUndefined
+
+from model import connect_to_db, pool_metrics
+import api
 import crud
+import export
+import http_cache
+import instrumentation
+import invalidation
+import loaders
+import passwords
+import rating_buffer
+import rating_import
+import warmup
+
+views = Blueprint("views", __name__)
+
+
+def _env_list(name):
+    return [item for item in os.environ.get(name, "").split(",") if item]
+
+
+def default_config():
+    """The settings create_app() starts from, read from the environment."""
+
+    return {
+        "SECRET_KEY": os.environ.get("SECRET_KEY", "dev"),
+        "DATABASE_URI": os.environ.get("DATABASE_URI", "postgresql:///ratings"),
+        "SQLALCHEMY_ECHO": False,
+        # Bearer tokens allowed to POST /ratings/import and GET /export/...,
+        # comma separated:
+        "RATING_IMPORT_TOKENS": _env_list("RATING_IMPORT_TOKENS"),
+        "EXPORT_TOKENS": _env_list("EXPORT_TOKENS"),
+        # Where compiled templates are kept, if anywhere:
+        "TEMPLATE_CACHE_DIR": os.environ.get("TEMPLATE_CACHE_DIR"),
+        # Open DB connections and load templates and the catalog on startup:
+        "WARMUP": os.environ.get("WARMUP", "") == "1",
+        # Evict what other processes' writes made stale from our movie
+        # cache (PostgreSQL only; see invalidation.py):
+        "CACHE_INVALIDATION": os.environ.get("CACHE_INVALIDATION", "1") == "1",
+        # Rebuild the recommendations this often, in seconds (0: never):
+        "RECOMMENDER_REFRESH_SECONDS": int(os.environ.get("RECOMMENDER_REFRESH_SECONDS",
+                                                          15 * 60)),
+        # Buffer /rate writes behind this journal (see rating_buffer.py):
+        "RATING_JOURNAL": os.environ.get("RATING_JOURNAL"),
+    }
+
+
+def create_app(config=None):
+    """Build the app, connected to DATABASE_URI.
+
+    config is a dict of settings overriding default_config() (and
+    passed on to the app's config, e.g. the DB_* pool settings).
+    """
+
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+    app.jinja_env.undefined = StrictUndefined
+
+    if app.config["TEMPLATE_CACHE_DIR"]:
+        os.makedirs(app.config["TEMPLATE_CACHE_DIR"], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config["TEMPLATE_CACHE_DIR"])
 
-from jinja2 import StrictUndefined
+    instrumentation.init_app(app)
+    http_cache.init_app(app)
+    loaders.init_app(app)
+    app.register_blueprint(views)
+    app.register_blueprint(api.api)
 
-app = Flask(__name__)
-app.secret_key = "dev"
-app.jinja_env.undefined = StrictUndefined
+    instrumentation.register_collector(
+        "movie_cache", lambda: crud.movie_cache.metrics("ratings_movie_cache"))
+    instrumentation.register_collector("db_pool", pool_metrics)
 
+    connect_to_db(app, app.config["DATABASE_URI"], echo=app.config["SQLALCHEMY_ECHO"])
 
+    if app.config["WARMUP"]:
+        warmup.warm_up(app)
+
+    app.before_first_request(lambda: start_background_threads(app))
+
+    return app
+
+
+def start_background_threads(app):
+    """Start the threads app's config asks for.
+
+    create_app runs this on each process's first request rather than
+    right away, so every worker gets its own threads, even workers forked
+    from a process that built the app (gunicorn --preload). Since it
+    runs inside a request, nothing here may push an app context: popping
+    it would remove the request's database session.
+    """
 
-@app.route("/")
+    if app.config["CACHE_INVALIDATION"]:
+        invalidation.start_listener(app, crud.evict_movies, crud.invalidate_movie_catalog)
+
+    if app.config["RECOMMENDER_REFRESH_SECONDS"]:
+        threading.Thread(target=_refresh_recommendations,
+                         args=(app, app.config["RECOMMENDER_REFRESH_SECONDS"]),
+                         name="recommender", daemon=True).start()
+
+    if app.config["RATING_JOURNAL"]:
+        rating_buffer.start(app, app.config["RATING_JOURNAL"])
+
+
+def _refresh_recommendations(app, interval):
+    # Imported here, off the request thread: NumPy and SciPy are slow to
+    # import, and the first request shouldn't wait for them.
+    import recommender
+    recommender.refresh_forever(app, interval)
+
+
+@views.route("/")
 def homepage():
     """Display homepage."""
 
     return render_template('homepage.html')
 
     
-@app.route("/users", methods=["POST"])
+@views.route("/users", methods=["POST"])
 def register_user():
     """Create a new user."""
 
@@ -28,7 +146,11 @@ def register_user():
     password = request.form.get("password")
 
     if not crud.does_this_user_exist_already(email):
-        crud.create_user(email, password)
+        try:
+            crud.create_user(email, password)
+        except passwords.HashPoolBusy:
+            flash("We're too busy to create your account right now. Please try again.")
+            return redirect("/")
         flash("Account created! Please log in.")
     else:
         flash("This user already exists! Please try again")
@@ -36,17 +158,24 @@ def register_user():
     return redirect("/")
 
 
-@app.route("/login", methods=["POST"])
+@views.route("/login", methods=["POST"])
 def login_user():
 
     email = request.form.get("email")
     password = request.form.get("password")
 
-    if crud.does_the_password_match(email, password):
+    try:
+        user = crud.authenticate_user(email, password)
+    except passwords.HashPoolBusy:
+        flash("We're too busy to log you in right now. Please try again.")
+        return redirect(request.referrer or "/")
+
+    if user:
         flash(f"Thanks for being a MoveeBuff™, {email}! Help us by rating some movies!")
 
         # Override on each new login:
         session["user_email"] = email
+        session["user_id"] = user.user_id
         
         return redirect("/movies")
     else:
@@ -54,7 +183,7 @@ def login_user():
         return redirect(request.referrer)
 
 
-@app.route("/rate", methods=["POST"])
+@views.route("/rate", methods=["POST"])
 def rate_movie():
 
     rating = request.form.get("rating")  # Any form reply back is a string.
@@ -69,83 +198,309 @@ def rate_movie():
         flash(nope_msg)
         return redirect(request.referrer)
 
+    if "user_id" not in session:
+        flash("Please log in to rate movies.")
+        return redirect("/")
+
     user_email = session["user_email"]
-    user = crud.get_user_by_email(user_email)
-    movie = crud.get_movie_by_id(session["movie_id"])
 
     """ 3 things can happen here:
     1. New rating -> add new rating
     2. old_score is the same as new_score. No action, flash message.
     3. Rating exists already and is new -> update.
+    All three are one upsert statement keyed on the ids in the session
+    (or a queued write, when rating_buffer is running).
     """
-    if crud.does_this_rating_exist_already(user, movie):
-        old_score = crud.get_score_for_existing_rating(user, movie)
-        if old_score == rating:
-            flash(f"No change to your previous rating of {rating}.")
-        else:
-            flash(f"Updating your rating from {old_score} to {rating}.")
-            crud.update_rating(user, movie, new_score=rating)
+    old_score, movie_title = rating_buffer.upsert_rating(
+        session["user_id"], session["movie_id"], rating)
+
+    if old_score is None:
+        flash(f"Thank you for your rating of {rating} for {movie_title}, {user_email}.")
+    elif old_score == rating:
+        flash(f"No change to your previous rating of {rating}.")
     else:
-        crud.create_rating(user, movie, score=rating)
-        flash(f"Thank you for your rating of {rating} for {movie.title}, {user_email}.")
+        flash(f"Updating your rating from {old_score} to {rating}.")
 
     return redirect(request.referrer)
 
+
+def require_bearer_token(tokens):
+    """Abort with a 401 unless the request has a bearer token in tokens."""
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not any(
+            hmac.compare_digest(token.strip().encode(), allowed.encode())
+            for allowed in tokens):
+        abort(401)
+
+
+@views.route("/ratings/import", methods=["POST"])
+def import_ratings():
+    """Create or update ratings in bulk from an NDJSON or CSV request body.
+
+    Needs an "Authorization: Bearer <token>" header with one of the
+    RATING_IMPORT_TOKENS. Send CSV as text/csv; anything else is read as
+    NDJSON. The body is streamed, not read into memory. Responds with the
+    import report as JSON.
+    """
+
+    require_bearer_token(current_app.config["RATING_IMPORT_TOKENS"])
+
+    format = "csv" if request.mimetype == "text/csv" else "ndjson"
+    lines = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+
+    return jsonify(rating_import.import_lines(lines, format))
+
+
+
+@views.route("/export/<table>")
+def export_table(table):
+    """Stream a whole table as CSV, NDJSON or Parquet.
+
+    ?format= picks the format (csv by default), ?gzip=1 compresses it, and
+    ?after=<key> resumes an export after the last key received. Needs an
+    "Authorization: Bearer <token>" header with one of the EXPORT_TOKENS.
+    """
+
+    require_bearer_token(current_app.config["EXPORT_TOKENS"])
+
+    format = request.args.get("format", "csv")
+    gzip = request.args.get("gzip", type=int, default=0) == 1
+    after = request.args.get("after")
+    try:
+        after = None if after is None else int(after)
+    except ValueError:
+        abort(400)
+
+    try:
+        chunks = export.export_table(table, format, gzip=gzip, after=after)
+    except ValueError:
+        abort(404)
+    except RuntimeError:
+        abort(501)
+
+    headers = {"Content-Disposition":
+               f'attachment; filename="{export.filename(table, format, gzip)}"'}
+
+    return Response(stream_with_context(chunks), headers=headers,
+                    mimetype="application/gzip" if gzip else export.FORMATS[format])
+
     
-@app.route("/movies")
+def get_page_args():
+    """Read the ?after=, ?before= and ?limit= paging arguments."""
+
+    return dict(after=request.args.get("after"),
+                before=request.args.get("before"),
+                limit=request.args.get("limit", crud.DEFAULT_PAGE_SIZE, type=int))
+
+
+@views.route("/movies")
 def all_movies():
-    """View all movies."""
-    movies = crud.get_movies()
+    """View all movies, one page at a time."""
+
+    import recommender
+
+    page_args = get_page_args()
+
+    etag = http_cache.make_etag("movies", crud.get_catalog_version(), page_args,
+                                session.get("user_id"), recommender.model_version())
+    not_modified = http_cache.not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    try:
+        page = crud.get_movies_page(**page_args)
+    except ValueError:
+        abort(400)
+
+    if "user_id" in session:
+        recommended = crud.get_movies_in_order(
+            recommender.recommend_for_user(session["user_id"]))
+    else:
+        recommended = []
+
+    return http_cache.with_etag(
+        render_template('all_movies.html', page=page, limit=page_args["limit"],
+                        recommended=recommended),
+        etag)
+
+
+@views.route("/movies/search")
+def search_movies():
+    """Search movie titles and overviews, one page of results at a time."""
+
+    query = request.args.get("q", "").strip()
+    page_args = get_page_args()
+
+    etag = http_cache.make_etag("search", crud.get_catalog_version(), query, page_args)
+    not_modified = http_cache.not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    try:
+        page = crud.search_movies(query, **page_args)
+    except ValueError:
+        abort(400)
+
+    return http_cache.with_etag(
+        render_template('search_results.html', query=query, page=page,
+                        limit=page_args["limit"], pager_args={"q": query}),
+        etag)
+
+
+@views.route("/movies/top")
+def top_movies():
+    """View the best rated movies, by Bayesian average."""
+
+    limit = request.args.get("limit", 100, type=int)
+
+    return render_template('ranked_movies.html', heading="Top MoveeBuffs™ Movies",
+                           movies=crud.get_top_movies(limit))
+
+
+@views.route("/movies/trending")
+def trending_movies():
+    """View the movies getting the most ratings lately."""
+
+    limit = request.args.get("limit", 100, type=int)
 
-    for movie_instance in movies:
-        moviebuffs_rating = crud.get_movie_rating(movie_instance)
-        movie_instance.average_rating = moviebuffs_rating[0]
-        movie_instance.rating_count = moviebuffs_rating[1]
+    return render_template('ranked_movies.html', heading="Trending with MoveeBuffs™",
+                           movies=crud.get_trending_movies(limit))
 
-    return render_template('all_movies.html', movies=movies)
 
+@views.route("/movies/stats")
+def many_movie_stats():
+    """Rating stats for the movies in ?ids=1,2,3 (up to a page's worth), as JSON."""
 
-@app.route("/movies/<movie_id>")
+    try:
+        movie_ids = [int(movie_id) for movie_id in request.args.get("ids", "").split(",")
+                     if movie_id.strip()]
+    except ValueError:
+        abort(400)
+    if len(movie_ids) > crud.MAX_PAGE_SIZE:
+        abort(400)
+
+    all_stats = crud.get_rating_stats(movie_ids)
+
+    return jsonify({str(movie_id): stats._asdict() for movie_id, stats in all_stats.items()})
+
+
+@views.route("/movies/<int:movie_id>/stats")
+def one_movie_stats(movie_id):
+    """One movie's rating stats (histogram, mean, stddev, median), as JSON."""
+
+    stats = crud.get_rating_stats([movie_id]).get(movie_id)
+    if stats is None:
+        abort(404)
+
+    return jsonify(stats._asdict())
+
+
+@views.route("/movies/<movie_id>")
 def one_movie(movie_id):
     """View one movie."""
 
+    import recommender
+
     movie_id = int(movie_id)
 
-    movie = crud.get_movie_by_id(movie_id)
+    # The page shows the movie, the user's own rating of it (as a flash)
+    # and the recommender's similar movies.
+    movie_version = crud.get_movie_version(movie_id)
+    if movie_version is None:
+        abort(404)
+    request_loaders = loaders.get_loaders()
+    user_id = request_loaders.current_user_id()
+    etag = http_cache.make_etag(
+        "movie", movie_id, movie_version, user_id,
+        user_id and crud.get_user_version(user_id), recommender.model_version())
+    not_modified = http_cache.not_modified(etag)
+    if not_modified:
+        session["movie_id"] = movie_id
+        return not_modified
+
+    # The movie and the similar ones come back from one (cached) IN query.
+    similar_ids = recommender.similar_movies(movie_id)
+    request_loaders.movies.defer(*similar_ids)
+    movie = request_loaders.movies.load(movie_id)
+    if movie is None:
+        abort(404)
+    average_rating, count_scores = crud.get_movie_rating(movie)
 
     # Put movie_id in session here: (override on each new page load)
     session["movie_id"] = movie_id
 
-    average_rating, count_scores = crud.get_movie_rating(movie)
+    if user_id is not None:
+        old_score = (rating_buffer.get_buffer()
+                     and rating_buffer.get_buffer().pending_score(user_id, movie_id))
+        if old_score is None:
+            rating = request_loaders.ratings.load((user_id, movie_id))
+            old_score = rating and rating.score
+        if old_score is not None:
+            flash(f"Your rating for {movie.title} is a {old_score}.")
+        else:
+            flash(f"You have not previously rated this movie.")
 
-    user = crud.get_user_by_email(session["user_email"])
-    if crud.does_this_rating_exist_already(user, movie):
-        old_score = crud.get_score_for_existing_rating(user, movie)
-        flash(f"Your rating for {movie.title} is a {old_score}.")
-    else:
-        flash(f"You have not previously rated this movie.")
+    similar = [similar_movie for similar_movie in
+               request_loaders.movies.load_many(similar_ids).values() if similar_movie]
+    stats = crud.rating_stats(movie)
 
-    return render_template('movie_details.html', movie=movie, rating_average=average_rating, num_users=count_scores)
+    return http_cache.with_etag(
+        render_template('movie_details.html', movie=movie, rating_average=average_rating, num_users=count_scores,
+                        similar=similar, stats=stats),
+        etag)
 
 
-@app.route("/users")
+@views.route("/users")
 def all_users():
-    """View all users."""
-    users = crud.get_users()
+    """View all users, one page at a time."""
+
+    page_args = get_page_args()
+    try:
+        page = crud.get_users_page(**page_args)
+    except ValueError:
+        abort(400)
 
-    return render_template('all_users.html', users=users)
+    return render_template('all_users.html', page=page, limit=page_args["limit"])
 
-@app.route("/user/<user_id>")
+@views.route("/user/<user_id>")
 def one_user(user_id):
-    """View one user."""
+    """View one user and a page of their ratings."""
+
+    user_version = crud.get_user_version(user_id)
+    if user_version is None:
+        abort(404)
+
+    # Movie averages on the page change with anyone's ratings, hence the
+    # catalog version.
+    page_args = get_page_args()
+    etag = http_cache.make_etag("user", user_id, user_version,
+                                crud.get_catalog_version(), page_args)
+    not_modified = http_cache.not_modified(etag)
+    if not_modified:
+        return not_modified
 
     user = crud.get_user_by_id(user_id)
+    try:
+        page = crud.get_user_ratings_page(user.user_id, **page_args)
+    except ValueError:
+        abort(400)
+
+    return http_cache.with_etag(
+        render_template('user_details.html', user=user, page=page,
+                        limit=page_args["limit"]),
+        etag)
+
+
+@views.route("/_cache")
+def cache_stats():
+    """Movie cache hit/miss/eviction counters, as JSON."""
 
-    return render_template('user_details.html', user=user)
+    return jsonify(crud.movie_cache.stats())
 
 
 if __name__ == "__main__":
-    connect_to_db(app)
+    app = create_app()
     # DebugToolbarExtension(app)
     app.jinja_env.auto_reload = True
     app.config['TEMPLATES_AUTO_RELOAD'] = False
@@ -155,7 +510,7 @@ if __name__ == "__main__":
 
 # from flask import request, session, flash, redirect
 
-# @app.route('/handle-login', methods=['POST'])
+# @views.route('/handle-login', methods=['POST'])
 # def handle_login():
 #     """Log user into application."""
 
@@ -0,0 +1,127 @@
+"""cache.Cache and its backends, plus when crud bumps the catalog."""
+
+from flask import Flask
+
+import cache
+import crud
+import model
+
+
+class FakeMemcached:
+    """Just enough of pymemcache's client for MemcachedBackend."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, expire=0):
+        assert len(key) <= 250 and key.isprintable() and " " not in key
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def add(self, key, value, expire=0, noreply=None):
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def incr(self, key, value, noreply=False):
+        if key not in self.data:
+            return None
+        self.data[key] = str(int(self.data[key]) + value).encode()
+        return int(self.data[key])
+
+
+def test_lru_evicts_the_least_recently_used():
+    backend = cache.LRUBackend(maxsize=2)
+    backend.set("a", 1)
+    backend.set("b", 2)
+    backend.get("a")
+    backend.set("c", 3)
+
+    assert backend.get("b") is cache.MISSING
+    assert (backend.get("a"), backend.get("c")) == (1, 3)
+    assert backend.stats()["evictions"] == 1
+
+
+def test_lru_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    backend = cache.LRUBackend(ttl=10)
+    backend.set("a", 1)
+
+    now[0] += 9
+    assert backend.get("a") == 1
+    now[0] += 2
+    assert backend.get("a") is cache.MISSING
+
+
+def test_bump_invalidates_only_its_namespace():
+    movie_cache = cache.Cache()
+    movie_cache.set(("catalog", "page"), "listing")
+    movie_cache.set(("movie", 1), "row")
+
+    movie_cache.bump("catalog")
+
+    assert movie_cache.get(("catalog", "page")) is cache.MISSING
+    assert movie_cache.get(("movie", 1)) == "row"
+    assert movie_cache.stats()["hits"] == 1
+
+
+def test_a_bump_during_a_load_discards_what_was_loaded():
+    movie_cache = cache.Cache()
+
+    def load_then_write():
+        movie_cache.bump("catalog")  # a write lands while we're loading
+        return "stale"
+
+    assert movie_cache.get_or_load(("catalog", "page"), load_then_write) == "stale"
+    assert movie_cache.get(("catalog", "page")) is cache.MISSING
+
+    movie_cache.clear()
+    assert movie_cache.get_or_load(("catalog", "page"), lambda: "fresh") == "fresh"
+    assert movie_cache.get(("catalog", "page")) == "fresh"
+
+
+def test_none_is_not_cached():
+    movie_cache = cache.Cache()
+    movie_cache.get_or_load(("movie", 1), lambda: None)
+
+    assert movie_cache.get_or_load(("movie", 1), lambda: "row") == "row"
+
+
+def test_memcached_versions_are_shared_and_keys_hashed():
+    client = FakeMemcached()
+    one, other = (cache.Cache(cache.MemcachedBackend(client)) for _ in range(2))
+    one.set(("catalog", "search", "star wars"), "results")
+
+    assert other.get(("catalog", "search", "starwars")) is cache.MISSING
+    assert other.get(("catalog", "search", "star wars")) == "results"
+
+    other.bump("catalog")
+    assert one.get(("catalog", "search", "star wars")) is cache.MISSING
+    one.bump("catalog")
+    assert one.backend.version("catalog") == other.backend.version("catalog") == 2
+
+
+def test_a_new_movie_bumps_the_catalog_once_committed():
+    app = Flask(__name__)
+    model.connect_to_db(app, "sqlite://")
+
+    with app.app_context():
+        model.db.create_all()
+        crud.invalidate_movie_catalog()
+        assert crud.get_movies_page().items == []
+
+        model.db.session.add(crud.create_movie("Uncommitted", "Not there yet."))
+        model.db.session.rollback()
+        assert crud.movie_cache.get(("catalog", "page", None, None, crud.DEFAULT_PAGE_SIZE)) is not cache.MISSING
+
+        model.db.session.add(crud.create_movie("Committed", "There now."))
+        model.db.session.commit()
+        assert [movie.title for movie in crud.get_movies_page().items] == ["Committed"]
+        model.db.session.remove()
@@ -0,0 +1,55 @@
+"""Engine options are picked per bind, from each bind's own URI.
+
+No database server needed: PostgreSQL engines are created but never
+connected to.
+"""
+
+import pytest
+from flask import Flask
+
+import model
+
+pytest.importorskip("psycopg2")
+
+
+def connected_app(db_uri, replica_uris):
+    app = Flask(__name__)
+    app.config["DB_POOL_SIZE"] = 3
+    model.connect_to_db(app, db_uri, replica_uris=replica_uris)
+
+    return app
+
+
+def test_sqlite_replica_of_a_postgresql_primary():
+    app = connected_app("postgresql:///ratings_test", ["sqlite://"])
+
+    primary = model.db.get_engine(app)
+    replica = model.db.get_engine(app, bind="replica0")
+
+    assert isinstance(primary.pool, model.InstrumentedQueuePool)
+    assert primary.pool.size() == 3
+    assert not isinstance(replica.pool, model.InstrumentedQueuePool)
+    with replica.connect() as connection:  # no application_name for sqlite3
+        assert connection.exec_driver_sql("SELECT 1").scalar() == 1
+
+
+def test_postgresql_replica_of_a_sqlite_primary():
+    app = connected_app("sqlite://", ["postgresql:///ratings_test"])
+
+    primary = model.db.get_engine(app)
+    replica = model.db.get_engine(app, bind="replica0")
+
+    assert not isinstance(primary.pool, model.InstrumentedQueuePool)
+    assert isinstance(replica.pool, model.InstrumentedQueuePool)
+    assert replica.pool.size() == 3
+    assert replica.pool._recycle == model.ENGINE_SETTINGS["DB_POOL_RECYCLE"][0]
+
+
+def test_pool_metrics_label_every_pool():
+    app = connected_app("postgresql:///ratings_test", ["sqlite://", "postgresql:///replica"])
+
+    with app.app_context():
+        metrics = {name: samples for name, _, _, samples in model.pool_metrics()}
+
+    assert metrics["ratings_db_pool_size"] == [({"bind": "primary"}, 3),
+                                               ({"bind": "replica1"}, 3)]
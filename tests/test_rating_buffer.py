@@ -0,0 +1,131 @@
+"""rating_buffer.RatingBuffer against a SQLite database.
+
+Buffers here are never start()ed unless the test is about startup, so
+nothing flushes behind the test's back.
+"""
+
+import os
+
+import pytest
+
+import crud
+import model
+import rating_buffer
+import server
+
+MOVIES = 3
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = server.create_app({"DATABASE_URI": f"sqlite:///{tmp_path / 'ratings.db'}",
+                             "CACHE_INVALIDATION": False, "RECOMMENDER_REFRESH_SECONDS": 0})
+    with app.app_context():
+        model.db.create_all()
+        model.db.session.add(crud.create_user("buffered@test.com", "test"))
+        model.db.session.add_all([crud.create_movie(f"Movie {n}", "Buffered.")
+                                  for n in range(MOVIES)])
+        model.db.session.commit()
+        model.db.session.remove()
+
+    return app
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return str(tmp_path / "journal.0")
+
+
+def scores(app):
+    with app.app_context():
+        try:
+            return {(rating.user_id, rating.movie_id): rating.score
+                    for rating in model.Rating.query}
+        finally:
+            model.db.session.remove()
+
+
+def new_buffer(app, journal, **options):
+    options.setdefault("fsync", False)
+    return rating_buffer.RatingBuffer(app, journal, **options)
+
+
+def test_journal_is_replayed_on_start(app, journal):
+    with open(journal + ".flushing", "w") as f:
+        f.write("1\t1\t1\n1\t2\t2\n")
+    with open(journal, "w") as f:
+        f.write("1\t1\t4\n1\t3\t")  # the last line was torn by a crash
+
+    buffer = new_buffer(app, journal, flush_interval=60)
+    buffer.start()
+    assert buffer.pending_score(1, 1) == 4
+    buffer.close()
+
+    assert scores(app) == {(1, 1): 4, (1, 2): 2}
+    assert not os.path.exists(journal + ".flushing")
+    assert open(journal).read() == ""
+
+
+def test_a_failed_flush_keeps_its_journal_for_the_next(app, journal, monkeypatch):
+    buffer = new_buffer(app, journal)
+    buffer.submit(1, 1, 3)
+    buffer.submit(1, 2, 3)
+
+    def fail(rows):
+        raise RuntimeError("database is down")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(crud, "import_ratings", fail)
+        with app.app_context(), pytest.raises(RuntimeError):
+            buffer.flush()
+
+    assert open(journal + ".flushing").read() == "1\t1\t3\n1\t2\t3\n"
+    buffer.submit(1, 1, 5)  # newer than the batch that failed
+
+    with app.app_context():
+        assert buffer.flush() == 2
+    assert scores(app) == {(1, 1): 5, (1, 2): 3}
+    assert not os.path.exists(journal + ".flushing")
+    buffer.close()
+
+
+def test_a_full_buffer_refuses_new_ratings(app, journal):
+    buffer = new_buffer(app, journal, max_pending=1, backpressure_timeout=0.01)
+    buffer.submit(1, 1, 3)
+
+    buffer.submit(1, 1, 4)  # replaces a pending rating: always fits
+    with pytest.raises(rating_buffer.BufferFull):
+        buffer.submit(1, 2, 4)
+
+    with app.app_context():
+        buffer.flush()
+    buffer.submit(1, 2, 4)
+    buffer.close()
+
+    assert scores(app) == {(1, 1): 4, (1, 2): 4}
+
+
+def test_close_flushes_and_refuses_more(app, journal):
+    buffer = new_buffer(app, journal, flush_interval=60)
+    buffer.start()
+    buffer.submit(1, 1, 2)
+    buffer.close()
+
+    assert scores(app) == {(1, 1): 2}
+    with pytest.raises(rating_buffer.BufferFull):
+        buffer.submit(1, 2, 2)
+
+
+def test_a_direct_write_is_not_overwritten_by_an_older_pending_score(
+        app, journal, monkeypatch):
+    buffer = new_buffer(app, journal)
+    monkeypatch.setattr(rating_buffer, "_buffer", buffer)
+    buffer.submit(1, 1, 3)
+    buffer._closing = True  # submit() now raises BufferFull
+
+    with app.app_context():
+        assert rating_buffer.upsert_rating(1, 1, 5) == (3, "Movie 0")
+        buffer.flush()  # what close() would do next
+
+    assert scores(app) == {(1, 1): 5}
+    assert buffer._read_journals() == {(1, 1): 5}  # what a crash would replay
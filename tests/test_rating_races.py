@@ -0,0 +1,122 @@
+"""Concurrent rating writes against PostgreSQL.
+
+    $ RATINGS_TEST_DB_URI=postgresql:///ratings_test python3 -m pytest tests
+
+Skipped unless RATINGS_TEST_DB_URI is set; that database's tables are
+dropped and recreated. Each test checks the movie rating summaries
+against the ratings table afterwards (crud.rebuild_movie_rating_stats).
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+import crud
+import model
+import server
+
+DB_URI = os.environ.get("RATINGS_TEST_DB_URI")
+
+pytestmark = pytest.mark.skipif(not DB_URI, reason="needs RATINGS_TEST_DB_URI (PostgreSQL)")
+
+MOVIES = 5
+
+
+@pytest.fixture
+def app():
+    app = server.create_app({"DATABASE_URI": DB_URI})
+    with app.app_context():
+        model.db.drop_all()
+        model.db.create_all()
+        crud.create_user("racer@test.com", "test")
+        model.db.session.add_all([crud.create_movie(f"Movie {n}", "Rated all at once.")
+                                  for n in range(MOVIES)])
+        model.db.session.commit()
+        model.db.session.remove()
+
+    return app
+
+
+def in_thread(app, function, *args):
+    """Run function(*args) in its own app context; return the thread and its results."""
+
+    results = []
+
+    def run():
+        with app.app_context():
+            try:
+                results.append(function(*args))
+            finally:
+                model.db.session.remove()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    return thread, results
+
+
+def assert_summaries_match(app):
+    with app.app_context():
+        assert crud.rebuild_movie_rating_stats(verify_only=True) == []
+        model.db.session.remove()
+
+
+def test_upsert_waiting_on_a_concurrent_insert(app):
+    params = {"user_id": 1, "movie_id": 1, "score": 2, "trending_key": 0}
+
+    with app.app_context():
+        # Another transaction inserts the rating, and holds on to it...
+        connection = model.db.engine.connect()
+        transaction = connection.begin()
+        connection.execute(crud._LOCK_RATING_SQL, params)
+        connection.execute(crud._UPSERT_RATING_SQL, params)
+
+        # ...while this upsert has to wait for it.
+        thread, results = in_thread(app, crud.upsert_rating, 1, 1, 5)
+        time.sleep(0.5)
+        transaction.commit()
+        connection.close()
+        thread.join()
+
+    assert results == [(2, "Movie 0")]  # an update of the other's rating
+    with app.app_context():
+        movie = crud.Movie.query.get(1)
+        assert (movie.rating_count, movie.rating_sum) == (1, 5)
+    assert_summaries_match(app)
+
+
+def test_concurrent_upserts_of_one_rating(app):
+    barrier = threading.Barrier(8)
+
+    def upsert(score):
+        barrier.wait()
+        return crud.upsert_rating(1, 1, score)
+
+    threads = [in_thread(app, upsert, score % 6) for score in range(8)]
+    for thread, _ in threads:
+        thread.join()
+
+    old_scores = [results[0][0] for _, results in threads]
+    assert old_scores.count(None) == 1  # created once, updated after that
+    assert_summaries_match(app)
+
+
+def test_concurrent_imports_of_the_same_ratings(app):
+    barrier = threading.Barrier(4)
+
+    def import_all(score):
+        barrier.wait()
+        counts, _ = crud.import_ratings(
+            [crud.ImportedRating(None, 1, None, movie_id, score)
+             for movie_id in range(1, MOVIES + 1)])
+        return counts
+
+    threads = [in_thread(app, import_all, score) for score in range(4)]
+    for thread, _ in threads:
+        thread.join()
+
+    created = sum(results[0]["created"] for _, results in threads)
+    assert created == MOVIES
+    assert_summaries_match(app)
@@ -0,0 +1,26 @@
+"""RatingsStore.from_copy: parsing COPY output."""
+
+import io
+import re
+
+import pytest
+
+from ratings_store import RatingsStore
+
+
+def test_tab_and_comma_separated_lines():
+    tabs = RatingsStore.from_copy(io.BytesIO(b"1\t10\t3\n2\t10\t5\n1\t11\t0"))
+    commas = RatingsStore.from_copy(io.StringIO("1,10,3\n2,10,5\n1,11,0\n"))
+
+    for store in (tabs, commas):
+        assert store.movie_index.tolist() == [10, 11]
+        assert store.movie_users.tolist() == [1, 2, 1]
+        assert store.movie_scores.tolist() == [3, 5, 0]
+
+
+@pytest.mark.parametrize("bad_line", ["7\t\\N\t3", "7\t8", "7\t8\t9\t10", "7\t8\t3x", ""])
+def test_a_bad_line_is_an_error_naming_it(bad_line):
+    dump = "1\t2\t3\n" * 10 + bad_line + "\n" + "4\t5\t6\n"
+
+    with pytest.raises(ValueError, match=f"line 11: .*{re.escape(repr(bad_line))}"):
+        RatingsStore.from_copy(io.StringIO(dump), chunk_bytes=20)
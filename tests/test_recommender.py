@@ -0,0 +1,32 @@
+"""The recommender model's version depends only on the ratings."""
+
+import numpy as np
+
+import recommender
+
+
+def ratings(seed=29):
+    rng = np.random.default_rng(seed)
+    pairs = np.unique(np.stack([rng.integers(1, 200, 5000),
+                                rng.integers(1, 300, 5000)], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1], rng.integers(0, 6, len(pairs))
+
+
+def test_same_ratings_in_any_order_give_the_same_version():
+    user_ids, movie_ids, scores = ratings()
+    shuffled = np.random.default_rng(1).permutation(len(scores))
+
+    model = recommender.ItemItemModel(user_ids, movie_ids, scores)
+    rebuilt = recommender.ItemItemModel(user_ids[shuffled], movie_ids[shuffled],
+                                        scores[shuffled])
+
+    assert model.version == rebuilt.version
+
+
+def test_a_changed_rating_changes_the_version():
+    user_ids, movie_ids, scores = ratings()
+    changed = scores.copy()
+    changed[0] = (changed[0] + 1) % 6
+
+    assert (recommender.ItemItemModel(user_ids, movie_ids, scores).version
+            != recommender.ItemItemModel(user_ids, movie_ids, changed).version)
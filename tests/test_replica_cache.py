@@ -0,0 +1,45 @@
+"""The movie cache is only ever filled from the primary.
+
+A lagging replica is played by a copy of the primary's SQLite file taken
+before the write.
+"""
+
+import shutil
+
+from flask import Flask
+
+import crud
+import model
+
+
+def test_cache_misses_read_the_primary_not_a_lagging_replica(tmp_path):
+    primary, replica = tmp_path / "primary.db", tmp_path / "replica.db"
+    app = Flask(__name__)
+    model.connect_to_db(app, f"sqlite:///{primary}", replica_uris=[f"sqlite:///{replica}"])
+    crud.invalidate_movie_catalog()
+
+    with app.app_context():
+        model.db.create_all()
+        user = crud.create_user("writer@test.com", "test")
+        movie = crud.create_movie("Lagging", "Read from a replica.")
+        model.db.session.add_all([user, movie])
+        model.db.session.commit()
+        user_id, movie_id = user.user_id, movie.movie_id
+        model.db.session.remove()
+        model.db.get_engine(app).dispose()
+    shutil.copy(primary, replica)
+
+    with app.app_context():
+        assert crud.get_movie_by_id(movie_id).rating_count == 0  # cached
+        crud.upsert_rating(user_id, movie_id, 5)  # evicts it
+        model.db.session.remove()
+
+    with app.app_context():
+        # An anonymous read (no read-your-writes window) misses the cache.
+        assert crud.get_movie_by_id(movie_id).rating_count == 1
+        assert crud.get_movies_page().items[0].rating_count == 1
+        model.db.session.remove()
+
+        # The replica really is behind; only the cache misses skipped it.
+        with model.reading_from_replica():
+            assert model.Movie.query.get(movie_id).rating_count == 0
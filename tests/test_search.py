@@ -0,0 +1,106 @@
+"""The in-process search fallback (search.SearchIndex) and its paging."""
+
+import pytest
+from flask import Flask
+
+import crud
+import model
+import search
+
+MOVIES = [
+    (1, "Star Wars", "A farm boy joins a rebellion against the galactic empire."),
+    (2, "Starship Troopers", "Soldiers fight giant bugs in space."),
+    (3, "The Empire Strikes Back", "The rebels regroup after the empire strikes."),
+    (4, "Frozen", "Two sisters and a snowman, in a kingdom frozen solid."),
+    (5, "Wars of the Roses", "A divorcing couple goes to war over their house."),
+]
+
+
+@pytest.fixture
+def index():
+    return search.SearchIndex(MOVIES)
+
+
+def test_tokenize_drops_stop_words_and_case():
+    assert search.tokenize("The Empire, Strikes BACK!") == ["empire", "strikes", "back"]
+    assert search.to_tsquery("the empire strik") == "empire & strik:*"
+    assert search.to_tsquery("the of") == ""
+
+
+def test_every_term_must_match(index):
+    assert index.search("empire strikes") == [3]
+    assert index.search("empire frozen") == []
+
+
+def test_only_the_last_term_is_a_prefix(index):
+    assert index.search("star") == [1, 2]
+    assert index.search("star wa") == [1]
+    assert index.search("farm rebell") == [1]
+    assert index.search("rebell farm") == []
+
+
+def test_typos_match_similar_title_words(index):
+    assert index.search("frozzen") == [4]
+    assert index.search("sttarship") == [2]
+    assert index.search("snowmann") == []  # overview words aren't typo-matched
+
+
+def test_title_matches_outrank_overview_matches(index):
+    # "empire" is in 3's title and in 1's overview.
+    assert index.search("empire") == [3, 1]
+
+
+def test_rare_terms_count_more(index):
+    # "wars" (two movies) decides it against "rebels" (one overview).
+    assert index.search("war")[:2] == [1, 5]
+
+
+def test_ties_rank_by_movie_id_and_limit_cuts(index):
+    assert index.search("star", limit=1) == [1]
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    model.connect_to_db(app, "sqlite://")
+
+    with app.app_context():
+        model.db.create_all()
+        crud.invalidate_movie_catalog()
+        model.db.session.add_all([crud.create_movie(f"Galaxy Quest {n}", "Space.")
+                                  for n in range(7)])
+        model.db.session.commit()
+        yield app
+        model.db.session.remove()
+
+
+def titles(page):
+    return [listing.title for listing in page.items]
+
+
+def test_search_pages_by_offset(app):
+    first = crud.search_movies("galaxy", limit=3)
+    assert titles(first) == [f"Galaxy Quest {n}" for n in range(3)]
+    assert first.prev_cursor is None
+    assert crud.decode_cursor(first.next_cursor) == 3
+
+    second = crud.search_movies("galaxy", after=first.next_cursor, limit=3)
+    assert titles(second) == [f"Galaxy Quest {n}" for n in range(3, 6)]
+    last = crud.search_movies("galaxy", after=second.next_cursor, limit=3)
+    assert titles(last) == ["Galaxy Quest 6"]
+    assert last.next_cursor is None
+
+    back = crud.search_movies("galaxy", before=last.prev_cursor, limit=3)
+    assert titles(back) == titles(second)
+
+
+def test_search_results_stop_at_max_search_results(app, monkeypatch):
+    monkeypatch.setattr(crud, "MAX_SEARCH_RESULTS", 4)
+
+    page = crud.search_movies("galaxy", limit=3)
+    assert crud.search_movies("galaxy", after=page.next_cursor, limit=3).next_cursor is None
+    assert crud.search_movies("galaxy", after=crud.encode_cursor(4)).items == []
+
+
+def test_search_without_terms_is_empty(app):
+    assert crud.search_movies("the of") == crud.Page([], None, None)
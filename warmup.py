@@ -0,0 +1,94 @@
+"""Work done when a worker starts, so its first requests don't pay for it.
+
+A cold worker used to compile each template, open each pool connection
+and load the catalog from the database during the first requests that
+needed them. warm_up(app) (create_app does it when WARMUP is set) does
+all of that before the worker takes traffic:
+
+- import_deferred imports what server.py's views import lazily;
+- load_templates compiles every templates/*.html, or, with the app's
+  TEMPLATE_CACHE_DIR filled by precompile_templates.py at build time,
+  just reads the compiled bytecode;
+- warm_pool opens as many connections as each pool keeps;
+- warm_catalog loads the first movie page and the rankings into the
+  movie cache.
+
+Each step is best effort: a failure is logged and the worker starts anyway.
+"""
+
+import importlib
+import time
+
+from sqlalchemy.pool import QueuePool
+
+import crud
+from model import db
+
+DEFERRED_IMPORTS = ("recommender",)  # slow to import (NumPy, SciPy)
+
+
+def import_deferred(app):
+    for name in DEFERRED_IMPORTS:
+        importlib.import_module(name)
+
+
+def template_names(app):
+    return app.jinja_env.list_templates(filter_func=lambda name: name.endswith(".html"))
+
+
+def load_templates(app):
+    """Compile (or load the bytecode of) every template; return how many."""
+
+    names = template_names(app)
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return len(names)
+
+
+def warm_pool(app):
+    """Open pool_size connections in each of app's pools; return how many."""
+
+    with app.app_context():
+        engines = [db.engine] + [db.get_engine(app, bind=key)
+                                 for key in app.config["REPLICA_BIND_KEYS"]]
+
+    opened = 0
+    for engine in engines:
+        size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+        connections = [engine.connect() for _ in range(size)]
+        for connection in connections:
+            connection.close()  # back into the pool, still open
+        opened += len(connections)
+
+    return opened
+
+
+def warm_catalog(app):
+    """Load the first page of /movies and the rankings into the movie cache."""
+
+    with app.app_context():
+        try:
+            crud.get_catalog_version()
+            crud.get_movies_page()
+            crud.get_top_movies()
+            crud.get_trending_movies()
+        finally:
+            db.session.remove()
+
+
+def warm_up(app):
+    """Run every warm-up step; return {step: seconds taken}."""
+
+    timings = {}
+    for step in (import_deferred, load_templates, warm_pool, warm_catalog):
+        started = time.perf_counter()
+        try:
+            step(app)
+        except Exception:
+            app.logger.exception("Warm-up step %s failed", step.__name__)
+        timings[step.__name__] = time.perf_counter() - started
+
+    app.logger.info("Warmed up in %.3fs: %s", sum(timings.values()), timings)
+
+    return timings